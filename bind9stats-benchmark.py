@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+
+"""
+bind9stats-benchmark.py
+
+Offline benchmarks for the bind9stats exporters. Generates synthetic
+but realistically shaped BIND9 statistics documents (XML v3 and JSON
+v1), scaled by number of zones, views, counters per counter group and
+memory contexts, and runs them through bind9stats-graphite.py and
+bind9stats-munin.py, reporting parse time, metric generation time,
+payload size and peak memory. No BIND or Graphite server is needed.
+
+"""
+
+import os
+import sys
+import io
+import time
+import json
+import getopt
+import random
+import zlib
+import importlib.util
+import tracemalloc
+from contextlib import redirect_stdout
+
+
+PROGNAME = os.path.basename(sys.argv[0])
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+
+OPCODES = ("QUERY", "IQUERY", "STATUS", "NOTIFY", "UPDATE")
+RCODES = ("NOERROR", "FORMERR", "SERVFAIL", "NXDOMAIN", "NOTIMP",
+          "REFUSED", "YXDOMAIN", "NXRRSET", "NOTAUTH", "BADVERS")
+QTYPES = ("A", "NS", "CNAME", "SOA", "PTR", "MX", "TXT", "AAAA", "SRV",
+          "NAPTR", "DS", "RRSIG", "NSEC", "DNSKEY", "NSEC3PARAM", "TLSA",
+          "SVCB", "HTTPS", "CAA", "AXFR", "IXFR", "ANY")
+NSSTATS = ("Requestv4", "Requestv6", "ReqEdns0", "ReqBadEDNSVer", "ReqTSIG",
+           "ReqTCP", "Response", "RespTSIG", "RespEDNS0", "QrySuccess",
+           "QryAuthAns", "QryNoauthAns", "QryReferral", "QryNxrrset",
+           "QrySERVFAIL", "QryFORMERR", "QryNXDOMAIN", "QryRecursion",
+           "QryDuplicate", "QryDropped", "QryFailure", "XfrReqDone",
+           "UpdateDone", "QryUDP", "QryTCP", "CookieIn", "CookieMatch")
+ZONESTATS = ("NotifyOutv4", "NotifyOutv6", "NotifyInv4", "SOAOutv4",
+             "AXFRReqv4", "IXFRReqv4", "XfrSuccess", "XfrFail")
+SOCKSTATS = ("UDP4Open", "UDP6Open", "TCP4Open", "TCP6Open", "UDP4Close",
+             "TCP4Close", "UDP4Conn", "TCP4Conn", "TCP4Accept", "TCP6Accept",
+             "UDP4RecvErr", "TCP4RecvErr", "UDP4Active", "TCP4Active")
+RESSTATS = ("Queryv4", "Queryv6", "Responsev4", "Responsev6", "NXDOMAIN",
+            "SERVFAIL", "FORMERR", "OtherError", "EDNS0Fail", "Truncated",
+            "Lame", "Retry", "QueryTimeout", "GlueFetchv4", "GlueFetchv6",
+            "ValAttempt", "ValOk", "ValNegOk", "ValFail", "QryRTT10",
+            "QryRTT100", "QryRTT500", "QryRTT800", "QryRTT1600",
+            "QryRTT1600+", "NumFetch", "BucketSize")
+ADBSTATS = ("nentries", "entriescnt", "nnames", "namescnt")
+CACHESTATS = ("CacheHits", "CacheMisses", "QueryHits", "QueryMisses",
+              "DeleteLRU", "DeleteTTL", "CacheNodes", "CacheBuckets",
+              "TreeMemTotal", "TreeMemInUse", "TreeMemMax", "HeapMemTotal",
+              "HeapMemInUse", "HeapMemMax")
+RRSETS = ("A", "NS", "CNAME", "SOA", "PTR", "MX", "TXT", "AAAA", "DS",
+          "RRSIG", "NSEC", "DNSKEY", "!A", "!AAAA", "NXDOMAIN")
+MEMORY_SUMMARY = ("TotalUse", "InUse", "Malloced", "BlockSize",
+                  "ContextSize", "Lost")
+CONTEXT_FIELDS = ("references", "total", "inuse", "maxinuse", "malloced",
+                  "maxmalloced", "pools", "hiwater", "lowater")
+TIMESTAMP = "2024-01-01T00:00:00.000Z"
+
+
+class Prefs:
+    """General Preferences"""
+    ZONES = 1000                                       # -z zones per view
+    VIEWS = 1                                          # -v views
+    QTYPES = len(QTYPES)                               # -g counters
+    CONTEXTS = 200                                     # -c contexts
+    REPEAT = 5                                         # -n repetitions
+    METRICS = "auth,res,bind,zone,memory"              # -m metric types
+    DERIVE = False                                     # -d
+    OUTDIR = None                                      # -w directory
+
+
+def usage(msg=None):
+    """Print Usage string"""
+    if msg is not None:
+        print(msg)
+    print("""\
+\nUsage: {0} [Options]
+
+    Options:
+    -h             Print this usage message
+    -z zones       Number of zones in each view (default: {1})
+    -v views       Number of views (default: {2})
+    -g counters    Number of query type counters in each qtype counter
+                   group (default: {3})
+    -c contexts    Number of memory contexts (default: {4})
+    -n repeat      Number of timed runs, the best is reported (default: {5})
+    -m metrics     Graphite exporter metric types (default: {6})
+    -d             Graphite exporter computes DERIVE rates
+    -w directory   Also write the generated documents to directory
+""".format(PROGNAME, Prefs.ZONES, Prefs.VIEWS, Prefs.QTYPES,
+           Prefs.CONTEXTS, Prefs.REPEAT, Prefs.METRICS))
+    sys.exit(1)
+
+
+def process_args(arguments):
+    """Process command line arguments"""
+    try:
+        (options, args) = getopt.getopt(arguments, 'hz:v:g:c:n:m:dw:')
+    except getopt.GetoptError:
+        usage("Argument processing error.")
+    if args:
+        usage("Too many arguments provided.")
+
+    for (opt, optval) in options:
+        if opt == "-h":
+            usage()
+        elif opt == "-z":
+            Prefs.ZONES = int(optval)
+        elif opt == "-v":
+            Prefs.VIEWS = int(optval)
+        elif opt == "-g":
+            Prefs.QTYPES = int(optval)
+        elif opt == "-c":
+            Prefs.CONTEXTS = int(optval)
+        elif opt == "-n":
+            Prefs.REPEAT = int(optval)
+        elif opt == "-m":
+            Prefs.METRICS = optval
+        elif opt == "-d":
+            Prefs.DERIVE = True
+        elif opt == "-w":
+            Prefs.OUTDIR = optval
+
+
+def load_script(filename, name):
+    """Import one of the (hyphenated) bind9stats scripts as a module"""
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(SRCDIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StatsGenerator:
+
+    """Generate synthetic BIND9 statistics with the layout of the XML v3
+    and JSON v1 statistics channel. The same counter values are used for
+    both formats, and values grow from one generation to the next, like
+    the counters of a running server."""
+
+    def __init__(self, zones, views, qtypes, contexts, seed=1):
+        rnd = random.Random(seed)
+        self.qtypes = QTYPES[:qtypes] + tuple(
+            "TYPE{}".format(65280 + i) for i in range(qtypes - len(QTYPES)))
+        self.views = ["_default"] + ["view{}".format(i)
+                                     for i in range(1, views)]
+        self.zones = ["zone{}.example".format(i) for i in range(zones)]
+        self.contexts = [("0x{:012x}".format(0x7f0000000000 + i * 4096),
+                          rnd.choice(("main", "client", "cache", "res0",
+                                      "adb", "zonemgr", "dst", "")))
+                         for i in range(contexts)]
+        self.base = rnd.randrange(1000000)
+        self.generation = 0
+
+    def value(self, *key):
+        """Deterministic counter value for a key, for this generation"""
+        crc = zlib.crc32(repr(key).encode())
+        return (crc % 100000 + self.base) * (self.generation + 1)
+
+    def counters(self, names, *key):
+        """Return an ordered dict of counter values"""
+        return {name: self.value(name, *key) for name in names}
+
+    def stats(self):
+        """Return the statistics as a JSON v1 style dictionary"""
+        self.generation += 1
+        stats = {
+            "json-stats-version": "1.5",
+            "boot-time": TIMESTAMP,
+            "config-time": TIMESTAMP,
+            "current-time": TIMESTAMP,
+            "version": "9.18.24",
+            "opcodes": self.counters(OPCODES, "opcode"),
+            "rcodes": self.counters(RCODES, "rcode"),
+            "qtypes": self.counters(self.qtypes, "qtype"),
+            "nsstats": self.counters(NSSTATS, "nsstat"),
+            "zonestats": self.counters(ZONESTATS, "zonestat"),
+            "sockstats": self.counters(SOCKSTATS, "sockstat"),
+            "views": {},
+        }
+        for view in self.views:
+            zones = []
+            for zone in self.zones:
+                zones.append({
+                    "name": zone,
+                    "class": "IN",
+                    "serial": 2024010100 + self.value(zone, view) % 100,
+                    "type": "primary",
+                    "rcodes": self.counters(RCODES, zone, view),
+                    "qtypes": self.counters(self.qtypes[:8], zone, view),
+                })
+            stats["views"][view] = {
+                "zones": zones,
+                "resolver": {
+                    "stats": self.counters(RESSTATS, "resstats", view),
+                    "qtypes": self.counters(self.qtypes, "resqtype", view),
+                    "cache": self.counters(RRSETS, "cache", view),
+                    "cachestats": self.counters(CACHESTATS, "cachestats", view),
+                    "adb": self.counters(ADBSTATS, "adb", view),
+                },
+            }
+        stats["views"]["_bind"] = {
+            "zones": [{"name": name, "class": "CH", "serial": 0,
+                       "type": "builtin"}
+                      for name in ("authors.bind", "hostname.bind",
+                                   "version.bind", "id.server")],
+            "resolver": {"cache": {}, "cachestats": {}},
+        }
+        memory = self.counters(MEMORY_SUMMARY, "memory")
+        memory["contexts"] = [
+            dict(self.counters(CONTEXT_FIELDS, cid), id=cid, name=name)
+            for (cid, name) in self.contexts]
+        stats["memory"] = memory
+        return stats
+
+
+def xml_counters(out, ctype, counters, indent):
+    """Append an XML counters element for a dictionary of counters"""
+    out.append('{}<counters type="{}">\n'.format(indent, ctype))
+    for (name, value) in counters.items():
+        out.append('{}  <counter name="{}">{}</counter>\n'.format(
+            indent, name, value))
+    out.append('{}</counters>\n'.format(indent))
+
+
+def stats_to_xml(stats):
+    """Render JSON v1 style statistics as an XML v3 document"""
+
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+           '<statistics version="3.11">\n', '  <server>\n']
+    for field in ('boot-time', 'config-time', 'current-time', 'version'):
+        out.append('    <{0}>{1}</{0}>\n'.format(field, stats[field]))
+    for (member, ctype) in (('opcodes', 'opcode'), ('rcodes', 'rcode'),
+                            ('qtypes', 'qtype'), ('nsstats', 'nsstat'),
+                            ('zonestats', 'zonestat'),
+                            ('sockstats', 'sockstat')):
+        xml_counters(out, ctype, stats[member], '    ')
+    out.append('  </server>\n  <views>\n')
+    for (viewname, view) in stats['views'].items():
+        out.append('    <view name="{}">\n      <zones>\n'.format(viewname))
+        for zone in view['zones']:
+            out.append('        <zone name="{}" rdataclass="{}">\n'
+                       '          <type>{}</type>\n'
+                       '          <serial>{}</serial>\n'.format(
+                           zone['name'], zone['class'], zone['type'],
+                           zone['serial']))
+            if 'rcodes' in zone:
+                xml_counters(out, 'rcode', zone['rcodes'], '          ')
+                xml_counters(out, 'qtype', zone['qtypes'], '          ')
+            out.append('        </zone>\n')
+        out.append('      </zones>\n')
+        resolver = view['resolver']
+        for (member, ctype) in (('qtypes', 'resqtype'), ('stats', 'resstats'),
+                                ('adb', 'adbstat'),
+                                ('cachestats', 'cachestats')):
+            if resolver.get(member):
+                xml_counters(out, ctype, resolver[member], '      ')
+        out.append('      <cache name="{}">\n'.format(viewname))
+        for (rrtype, count) in resolver['cache'].items():
+            out.append('        <rrset><name>{}</name><counter>{}</counter>'
+                       '</rrset>\n'.format(rrtype, count))
+        out.append('      </cache>\n    </view>\n')
+    out.append('  </views>\n  <memory>\n    <contexts>\n')
+    for context in stats['memory']['contexts']:
+        out.append('      <context>')
+        for field in ('id', 'name') + CONTEXT_FIELDS:
+            out.append('<{0}>{1}</{0}>'.format(field, context[field]))
+        out.append('</context>\n')
+    out.append('    </contexts>\n    <summary>\n')
+    for field in MEMORY_SUMMARY:
+        out.append('      <{0}>{1}</{0}>\n'.format(
+            field, stats['memory'][field]))
+    out.append('    </summary>\n  </memory>\n</statistics>\n')
+    return ''.join(out).encode()
+
+
+def stats_to_json(stats):
+    """Render statistics as a JSON v1 document"""
+    return json.dumps(stats, indent=2).encode()
+
+
+class SnapshotResponse(io.BytesIO):
+    """An in-memory HTTP response, optionally with a content encoding"""
+    status = 200
+    reason = 'OK'
+
+    def __init__(self, data, encoding=None):
+        super().__init__(data)
+        self.encoding = encoding
+
+    def getheader(self, name, default=None):
+        """Return the Content-Encoding header, if any"""
+        if name.lower() == 'content-encoding' and self.encoding:
+            return self.encoding
+        return default
+
+
+class SnapshotConnection:
+
+    """Stand-in for bind9stats-graphite's StatsConnection, serving a
+    statistics document from memory, so that the exporter's own fetch
+    and parse code is benchmarked without a BIND server"""
+
+    def __init__(self, encoding=None):
+        self.document = b''
+        self.encoding = encoding       # content encoding of the documents
+        self.requests = 0
+        self.reused = 0
+        self.connects = 0
+        self.wait_time = 0.0
+        self.wire_bytes = 0
+        self.document_bytes = 0
+
+    def url(self, path):
+        """Return URL for the given path, for messages"""
+        return "snapshot:{}".format(path)
+
+    def get(self, path):
+        """Return the current document"""
+        self.requests += 1
+        return SnapshotResponse(self.document, self.encoding)
+
+
+def best_of(function, repeat):
+    """Return the shortest of repeat timed calls of function"""
+    best = None
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - time_start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_memory(function):
+    """Return the peak memory allocated while running function"""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_graphite(b9g, documents, stats_type, stream, sample=False,
+                   compress=False):
+
+    """Benchmark bind9stats-graphite.py: parse (Bind9Stats.poll from an
+    in-memory connection) and generate_all_data() on the second of two
+    documents, so that DERIVE rates can be computed, and the size of
+    the plaintext and pickle payloads. With sample, an intermediate
+    sample of the sampling mode is generated instead. With compress,
+    the documents are served deflate compressed, and the size on the
+    wire is reported instead of the pickle payload's."""
+
+    graphs = b9g.graphs
+    stats = b9g.Bind9Stats('snapshot', 0, 5,
+                           paths=graphs.stream_paths() if stream else None,
+                           stats_type=stats_type,
+                           zone_counters=graphs.zonestats_location
+                           if graphs.metrics['zonestats'] else None,
+                           memory_contexts=graphs.memcontexts_location
+                           if graphs.metrics['memcontexts'] else None)
+    stats.conn = SnapshotConnection('deflate' if compress else None)
+    if compress:
+        documents = [zlib.compress(x) for x in documents]
+    b2g = b9g.Bind2Graphite(stats, 'graphite', 0, name='ns1',
+                            sample_interval=1 if sample else None)
+
+    def parse():
+        stats.conn.document = documents[1]
+        stats.poll(sample=sample)
+
+    def generate():
+        if sample:
+            b2g.generate_sample_data()
+        else:
+            b2g.generate_all_data()
+
+    def cycle():
+        parse()
+        generate()
+        b2g.encode()
+
+    stats.conn.document = documents[0]
+    stats.poll()
+    b2g.generate_all_data()
+    parse_time = best_of(parse, Prefs.REPEAT)
+    generate_time = best_of(generate, Prefs.REPEAT)
+    if sample:
+        b2g.generate_all_data()
+    pickle_sender = b9g.PickleSender('graphite', 0)
+    plaintext = b2g.encode()
+    pickled = b2g.encode(pickle_sender)
+    text_time = best_of(b2g.encode, Prefs.REPEAT)
+    pickle_time = best_of(lambda: b2g.encode(pickle_sender), Prefs.REPEAT)
+    if compress:
+        extra = "wire {:.1f}KB".format(len(documents[1]) / 1024)
+    else:
+        extra = "pickle {:.1f}KB".format(len(pickled) / 1024)
+    return dict(parse=parse_time, generate=generate_time,
+                text=text_time, pickle=pickle_time,
+                metrics=len(b2g.datapoints) + len(b2g.uncached),
+                payload=len(plaintext),
+                extra=extra, peak=peak_memory(cycle))
+
+
+def bench_munin(munin, documents, stats_type):
+
+    """Benchmark bind9stats-munin.py: get_etree_root() on a document
+    (fetched from memory, as if from the snapshot cache), and the
+    output of munindata() and muninconfig()"""
+
+    munin.STATS_TYPE = stats_type
+    munin.get_stats = lambda url: documents[1]
+    tree = munin.get_etree_root(munin.BINDSTATS_URL)
+
+    def parse():
+        munin.get_etree_root(munin.BINDSTATS_URL)
+
+    def output(function):
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            function(tree)
+        return buf.getvalue()
+
+    def cycle():
+        output(munin.munindata)
+
+    parse_time = best_of(parse, Prefs.REPEAT)
+    generate_time = best_of(lambda: output(munin.munindata), Prefs.REPEAT)
+    values = output(munin.munindata)
+    config = output(munin.muninconfig)
+    return dict(parse=parse_time, generate=generate_time,
+                text=None, pickle=None,
+                metrics=values.count('.value '), payload=len(values),
+                extra="config {:.1f}KB".format(len(config) / 1024),
+                peak=peak_memory(lambda: (parse(), cycle())))
+
+
+def print_result(exporter, stats_type, mode, result):
+    """Print a line of the results table"""
+    encode_times = ["{:.1f}".format(result[x] * 1000)
+                    if result[x] is not None else "-"
+                    for x in ('text', 'pickle')]
+    print("{:<9} {:<5} {:<7} {:>10.1f} {:>10.1f} {:>10} {:>10} {:>9} {:>11.1f}"
+          " {:>9.1f}  {}".format(exporter, stats_type, mode,
+                                 result['parse'] * 1000,
+                                 result['generate'] * 1000,
+                                 encode_times[0], encode_times[1],
+                                 result['metrics'], result['payload'] / 1024,
+                                 result['peak'] / 1048576, result['extra']))
+
+
+if __name__ == '__main__':
+
+    process_args(sys.argv[1:])
+
+    b9g = load_script('bind9stats-graphite.py', 'bind9stats_graphite')
+    munin = load_script('bind9stats-munin.py', 'bind9stats_munin')
+
+    for metric in Prefs.METRICS.split(','):
+        if metric not in b9g.METRICS:
+            usage("Unsupported metric type: {}".format(metric))
+        b9g.METRICS[metric] = True
+    b9g.Prefs.DERIVE = Prefs.DERIVE
+    b9g.graphs = b9g.Graphs(b9g.METRICS)
+
+    generator = StatsGenerator(Prefs.ZONES, Prefs.VIEWS, Prefs.QTYPES,
+                               Prefs.CONTEXTS)
+    snapshots = [generator.stats(), generator.stats()]
+    documents = {
+        'xml': [stats_to_xml(x) for x in snapshots],
+        'json': [stats_to_json(x) for x in snapshots],
+    }
+    del snapshots
+
+    print("zones={} views={} qtypes={} contexts={} repeat={} metrics={}{}".format(
+        Prefs.ZONES, Prefs.VIEWS, Prefs.QTYPES, Prefs.CONTEXTS, Prefs.REPEAT,
+        Prefs.METRICS, " derive" if Prefs.DERIVE else ""))
+    for (stats_type, docs) in documents.items():
+        print("{} document: {:.1f}KB".format(stats_type, len(docs[1]) / 1024))
+        if Prefs.OUTDIR is not None:
+            with open(os.path.join(Prefs.OUTDIR,
+                                   "statistics.{}".format(stats_type)),
+                      'wb') as f:
+                f.write(docs[1])
+    print("")
+    print("{:<9} {:<5} {:<7} {:>10} {:>10} {:>10} {:>10} {:>9} {:>11} {:>9}"
+          .format("exporter", "type", "mode", "parse(ms)", "gen(ms)",
+                  "text(ms)", "pickle(ms)", "metrics", "payload(KB)",
+                  "peak(MB)"))
+
+    for (stats_type, stream) in (('xml', False), ('xml', True),
+                                 ('json', False)):
+        result = bench_graphite(b9g, documents[stats_type], stats_type, stream)
+        print_result('graphite', stats_type, 'stream' if stream else 'full',
+                     result)
+    for (stats_type, stream) in (('xml', True), ('json', False)):
+        result = bench_graphite(b9g, documents[stats_type], stats_type, stream,
+                                compress=True)
+        print_result('graphite', stats_type, 'deflate', result)
+    if Prefs.DERIVE:
+        result = bench_graphite(b9g, documents['xml'], 'xml', True,
+                                sample=True)
+        print_result('graphite', 'xml', 'sample', result)
+    for stats_type in ('xml', 'json'):
+        result = bench_munin(munin, documents[stats_type], stats_type)
+        print_result('munin', stats_type, 'full', result)
@@ -16,18 +16,33 @@ Author: Shumon Huque <shuque@gmail.com>
 
 import os
 import sys
+import re
 import time
+import json
+import gzip
+import zlib
+import heapq
+import pickle
+import struct
 import calendar
 import socket
 import getopt
 import syslog
+import queue
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from array import array
+from functools import partial
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 try:
     import lxml.etree as et
 except ImportError:
     import xml.etree.ElementTree as et
-from urllib.request import urlopen
-from urllib.error import URLError
+import http.client
+import http.server
 
 
 PROGNAME = os.path.basename(sys.argv[0])
@@ -37,6 +52,7 @@ DEFAULT_BIND9_HOST = '127.0.0.1'
 DEFAULT_BIND9_PORT = '8053'
 DEFAULT_GRAPHITE_HOST = '127.0.0.1'
 DEFAULT_GRAPHITE_PORT = '2003'
+DEFAULT_GRAPHITE_PICKLE_PORT = '2004'
 
 # Hash table specifying which metric types to export.
 METRICS = {
@@ -44,8 +60,56 @@ METRICS = {
     'res': False,
     'bind': False,
     'zone': False,
+    'zonestats': False,
     'memory': False,
+    'memcontexts': False,
     'socket': False,
+    'exporter': False,
+}
+
+# Statistics channel formats, and the schema version of their sub-resources
+STATS_VERSIONS = {
+    'xml': 'v3',
+    'json': 'v1',
+}
+
+# JSON statistics members and the XML counters types they correspond to
+JSON_SERVER_COUNTERS = (
+    ('opcodes', 'opcode'),
+    ('rcodes', 'rcode'),
+    ('qtypes', 'qtype'),
+    ('nsstats', 'nsstat'),
+    ('zonestats', 'zonestat'),
+    ('resstats', 'resstat'),
+    ('sockstats', 'sockstat'),
+)
+JSON_RESOLVER_COUNTERS = (
+    ('qtypes', 'resqtype'),
+    ('stats', 'resstats'),
+    ('adb', 'adbstat'),
+    ('cachestats', 'cachestats'),
+)
+
+# Statistics channel sub-resources needed by each metric type.
+SUBRESOURCES = {
+    'auth': ('server',),
+    'res': ('server',),
+    'bind': ('server',),
+    'zone': ('zones',),
+    'zonestats': ('zones',),
+    'memory': ('mem',),
+    'memcontexts': ('mem',),
+    'socket': ('net',),
+    'exporter': (),
+}
+
+# Fields of the memory contexts that are used, and converted from JSON
+MEMORY_CONTEXT_FIELDS = ('id', 'name', 'inuse')
+
+# Per-zone counters types (zone-statistics), and their metric categories
+ZONE_COUNTER_TYPES = {
+    'rcode': 'dns_zone_rcode',
+    'qtype': 'dns_zone_qtype',
 }
 
 class Prefs:
@@ -62,9 +126,33 @@ class Prefs:
     BIND9_HOST = os.environ.get('BIND9_HOST', DEFAULT_BIND9_HOST)
     BIND9_PORT = os.environ.get('BIND9_PORT', DEFAULT_BIND9_PORT)
     GRAPHITE_HOST = os.environ.get('GRAPHITE_HOST', DEFAULT_GRAPHITE_HOST)
-    GRAPHITE_PORT = int(os.environ.get('GRAPHITE_PORT', DEFAULT_GRAPHITE_PORT))
+    GRAPHITE_PORT = os.environ.get('GRAPHITE_PORT', None)     # -p
     TIMEOUT = 5
+    TARGETS = None                                     # -t targets file
+    WORKERS = 16                                       # -o workers=N
+    PICKLE = False                                     # -o pickle
+    BATCH_SIZE = 500                                   # -o batch=N
+    SPOOL_DIR = None                                   # -o spool=DIR
+    SPOOL_SIZE = 100                                   # -o spoolsize=MB
+    SPOOL_AGE = 86400                                  # -o spoolage=secs
+    SPOOL_REPLAY = 512                                 # -o replay=KB
+    QUEUE_SIZE = 16                                    # -o queue=N
+    ONCHANGE = 0                                       # -o onchange=N
+    ZONE_RATE = 0                                      # -o zonerate=N
+    VIEWS = None                                       # -o views=a:b
+    SKIP_VIEWS = ('_bind',)                            # -o skipviews=a:b
+    PROMETHEUS = None                                  # -o prometheus=PORT
+    PROFILE_DIR = None                                 # -o profile=DIR
+    PROFILE_CYCLES = 10                                # -o profilecycles=N
+    SAMPLE = None                                      # -o sample=SECS
+    JITTER = None                                      # -o jitter[=SECS]
+    COMPRESS = False                                   # -o compress
+    MEMTOP = 10                                        # -o memtop=N
+    MEMGROWTH = False                                  # -o memgrowth
     DERIVE = False                                     # -o derive
+    STREAM = False                                     # -o stream
+    SPLIT = False                                      # -o split
+    STATS_TYPE = os.environ.get('BIND9_STATS_TYPE', 'xml')  # -o json
 
 
 def usage(msg=None):
@@ -84,25 +172,83 @@ def usage(msg=None):
     -n name        Specify server name (default: 1st component of hostname)
     -i interval    Polling interval in seconds (default: {3} sec)
     -s server      Graphite server IP address (default: {4})
-    -p port        Graphite server port (default: {5})
+    -p port        Graphite server port (default: {5}, or {6} with pickle)
     -r             Really send data to Graphite (default: don't)
+    -t targets     File listing BIND servers to poll concurrently, one
+                   "name host [port]" per line (default: poll one server
+                   given by BIND9_HOST and BIND9_PORT, named by -n)
 
     -o options     Other comma separated options (default: none)
-                   (supported: derive)
+                   (supported: derive,stream,split,json,workers=N,
+                    pickle,batch=N,spool=DIR,spoolsize=MB,
+                    spoolage=secs,replay=KB,queue=N,onchange=N,
+                    zonerate=N,views=V1:V2,skipviews=V1:V2,
+                    prometheus=[ADDR:]PORT,profile=DIR,
+                    profilecycles=N,sample=SECS,jitter[=SECS],
+                    compress,memtop=N,memgrowth)
 """.format(PROGNAME,
            Prefs.METRICS,
            ",".join(METRICS.keys()),
            Prefs.POLL_INTERVAL,
            DEFAULT_GRAPHITE_HOST,
-           DEFAULT_GRAPHITE_PORT))
+           DEFAULT_GRAPHITE_PORT,
+           DEFAULT_GRAPHITE_PICKLE_PORT))
     sys.exit(1)
 
 
 def set_other_options(args):
     """Set other options from a comma separated list specified with -o"""
     for opt in args.split(','):
+        (opt, _, value) = opt.partition('=')
         if opt == "derive":
             Prefs.DERIVE = True
+        elif opt == "stream":
+            Prefs.STREAM = True
+        elif opt == "split":
+            Prefs.SPLIT = True
+        elif opt == "json":
+            Prefs.STATS_TYPE = "json"
+        elif opt == "workers":
+            Prefs.WORKERS = int(value)
+        elif opt == "pickle":
+            Prefs.PICKLE = True
+        elif opt == "batch":
+            Prefs.BATCH_SIZE = int(value)
+        elif opt == "spool":
+            Prefs.SPOOL_DIR = os.path.abspath(value)
+        elif opt == "spoolsize":
+            Prefs.SPOOL_SIZE = int(value)
+        elif opt == "spoolage":
+            Prefs.SPOOL_AGE = int(value)
+        elif opt == "replay":
+            Prefs.SPOOL_REPLAY = int(value)
+        elif opt == "queue":
+            Prefs.QUEUE_SIZE = int(value)
+        elif opt == "onchange":
+            Prefs.ONCHANGE = int(value)
+        elif opt == "zonerate":
+            Prefs.ZONE_RATE = float(value)
+        elif opt == "views":
+            Prefs.VIEWS = tuple(x for x in value.split(':') if x)
+        elif opt == "skipviews":
+            Prefs.SKIP_VIEWS = tuple(x for x in value.split(':') if x)
+        elif opt == "prometheus":
+            (address, _, port) = value.rpartition(':')
+            Prefs.PROMETHEUS = (address, int(port))
+        elif opt == "profile":
+            Prefs.PROFILE_DIR = os.path.abspath(value)
+        elif opt == "profilecycles":
+            Prefs.PROFILE_CYCLES = int(value)
+        elif opt == "sample":
+            Prefs.SAMPLE = int(value)
+        elif opt == "jitter":
+            Prefs.JITTER = float(value) if value else 0.0
+        elif opt == "compress":
+            Prefs.COMPRESS = True
+        elif opt == "memtop":
+            Prefs.MEMTOP = int(value)
+        elif opt == "memgrowth":
+            Prefs.MEMGROWTH = True
         else:
             usage("Unrecognized option: {}".format(opt))
 
@@ -110,7 +256,7 @@ def set_other_options(args):
 def process_args(arguments):
     """Process command line arguments"""
     try:
-        (options, args) = getopt.getopt(arguments, 'hdfm:n:i:s:p:ro:')
+        (options, args) = getopt.getopt(arguments, 'hdfm:n:i:s:p:rt:o:')
     except getopt.GetoptError:
         usage("Argument processing error.")
     if args:
@@ -132,12 +278,44 @@ def process_args(arguments):
         elif opt == "-s":
             Prefs.GRAPHITE_HOST = optval
         elif opt == "-p":
-            Prefs.GRAPHITE_PORT = int(optval)
+            Prefs.GRAPHITE_PORT = optval
         elif opt == "-r":
             Prefs.SEND = True
+        elif opt == "-t":
+            Prefs.TARGETS = optval
         elif opt == "-o":
             set_other_options(optval)
 
+    if Prefs.GRAPHITE_PORT is None:
+        Prefs.GRAPHITE_PORT = DEFAULT_GRAPHITE_PICKLE_PORT if Prefs.PICKLE \
+            else DEFAULT_GRAPHITE_PORT
+    Prefs.GRAPHITE_PORT = int(Prefs.GRAPHITE_PORT)
+
+    if Prefs.STATS_TYPE not in STATS_VERSIONS:
+        usage("{} is not a valid statistics type.".format(Prefs.STATS_TYPE))
+
+    if Prefs.SAMPLE is not None:
+        if not Prefs.DERIVE:
+            usage("The sample option needs the derive option.")
+        if not 0 < Prefs.SAMPLE < Prefs.POLL_INTERVAL:
+            usage("The sample interval must be shorter than the "
+                  "polling interval.")
+        if Prefs.TARGETS is not None:
+            usage("The sample option cannot be used with -t.")
+
+    if Prefs.PROFILE_DIR is not None and Prefs.TARGETS is not None:
+        usage("The profile option cannot be used with -t: profile a "
+              "single server instead.")
+
+    if Prefs.JITTER is not None:
+        if Prefs.JITTER == 0:
+            Prefs.JITTER = float(Prefs.POLL_INTERVAL)
+        elif not 0 < Prefs.JITTER <= Prefs.POLL_INTERVAL:
+            usage("The jitter must be at most the polling interval.")
+
+    if Prefs.MEMTOP < 1:
+        usage("The memtop option must be at least 1.")
+
     for metric in Prefs.METRICS.split(','):
         if metric in METRICS:
             METRICS[metric] = True
@@ -177,7 +355,8 @@ class Graphs:
              dict(enable=self.metrics['res'],
                   stattype='cachedb',
                   metrictype='GAUGE',
-                  location="views/view[@name='_default']/cache[@name='_default']/rrset")),
+                  scope='view',
+                  location="cache/rrset")),
 
             ('dns_resolver_stats',
              dict(enable=False,                         # appears to be empty
@@ -189,19 +368,22 @@ class Graphs:
              dict(enable=self.metrics['res'],
                   stattype='counter',
                   metrictype='DERIVE',
-                  location="views/view[@name='_default']/counters[@type='resqtype']/counter")),
+                  scope='view',
+                  location="counters[@type='resqtype']/counter")),
 
             ('dns_resolver_stats_defview',
              dict(enable=self.metrics['res'],
                   stattype='counter',
                   metrictype='DERIVE',
-                  location="views/view[@name='_default']/counters[@type='resstats']/counter")),
+                  scope='view',
+                  location="counters[@type='resstats']/counter")),
 
             ('dns_cachestats',
              dict(enable=self.metrics['res'] and self.metrics['memory'],
                   stattype='counter',
                   metrictype='DERIVE',
-                  location="views/view[@name='_default']/counters[@type='cachestats']/counter")),
+                  scope='view',
+                  location="counters[@type='cachestats']/counter")),
 
             ('dns_socket_activity',
              dict(enable=self.metrics['socket'],
@@ -233,10 +415,79 @@ class Graphs:
              dict(enable=False,
                   stattype='counter',
                   metrictype='GAUGE',
-                  location="views/view[@name='_default']/counters[@type='adbstat']/counter")),
+                  scope='view',
+                  location="counters[@type='adbstat']/counter")),
 
         ]
 
+        # Locations read directly by Bind2Graphite rather than via params
+        self.bind_locations = ("server/boot-time", "server/config-time")
+        self.zone_locations = ("views/view/zones/zone/type",
+                               "views/view/zones/zone/serial")
+        self.zonestats_location = "views/view/zones/zone/counters"
+        self.memcontexts_location = "memory/contexts/context"
+
+        # params with scope='view' have locations relative to each view
+        self.view_location = "views/view"
+
+        self.dispatch = self.compile_dispatch('server')
+        self.view_dispatch = self.compile_dispatch('view')
+
+    def compile_dispatch(self, scope):
+
+        """Compile the enabled params of the given scope into a dispatch
+        table, grouping graphs that read the same location so that each
+        statistics section is read only once. Returns a list of
+        (graphconfig, consumers) tuples, where consumers is a list of
+        (graphname, is_derive, fields) for every graph reading that
+        location, and fields is a frozenset of wanted keys, or None for
+        all keys."""
+
+        table = {}
+        for (graphname, graphconfig) in self.params:
+            if not graphconfig['enable']:
+                continue
+            if graphconfig.get('scope', 'server') != scope:
+                continue
+            location = graphconfig['location']
+            if location not in table:
+                table[location] = (graphconfig, [])
+            fields = graphconfig.get('fields', None)
+            table[location][1].append(
+                (graphname,
+                 graphconfig['metrictype'] == 'DERIVE',
+                 frozenset(fields) if fields else None))
+        return list(table.values())
+
+    def locations(self):
+        """Return the XML locations needed by the enabled metrics"""
+        result = []
+        if self.metrics['bind']:
+            result.extend(self.bind_locations)
+        if self.metrics['zone']:
+            result.extend(self.zone_locations)
+        for (_, graphconfig) in self.params:
+            if not graphconfig['enable']:
+                continue
+            if graphconfig.get('scope', 'server') == 'view':
+                result.append("{}/{}".format(self.view_location,
+                                             graphconfig['location']))
+            else:
+                result.append(graphconfig['location'])
+        return result
+
+    def stream_paths(self):
+        """Return the needed locations as paths for stream_etree_root()"""
+        return [location_steps(x) for x in set(self.locations())]
+
+    def resources(self):
+        """Return the statistics sub-resources needed by enabled metrics"""
+        result = set()
+        for (metric, enabled) in self.metrics.items():
+            if enabled:
+                result.update(SUBRESOURCES[metric])
+        return sorted(result)
+
 
 def daemon(dirname=None, syslog_fac=syslog.LOG_DAEMON, umask=0o022):
 
@@ -273,32 +524,428 @@ def log_message(msg):
         print(msg)
 
 
-def validkey(graphconfig, key):
-    """Are we interested in this key?"""
-    fieldlist = graphconfig.get('fields', None)
-    if fieldlist and (key not in fieldlist):
-        return False
-    return True
-
-
 def dot2underscore(instring):
     """replace periods with underscores in given string"""
     return instring.replace('.', '_')
 
 
-def get_xml_etree_root(url, timeout):
+def poll_phase(name, spread):
+    """Return a poll phase for a host name: a fixed offset from the
+    start of each interval, between 0 and spread seconds, spread evenly
+    over host names, so that a fleet does not poll all at once"""
+    return round(zlib.crc32(name.encode()) / 2**32 * spread, 3)
+
+
+def view_prefix(viewname):
+    """Return the metric category prefix for a view, or None if the view
+    is not selected by the views and skipviews options. Metrics of the
+    _default view keep their original names; those of other views are
+    put under views.<viewname>."""
+    if Prefs.VIEWS is not None and viewname not in Prefs.VIEWS:
+        return None
+    if viewname in Prefs.SKIP_VIEWS:
+        return None
+    if viewname == '_default':
+        return ''
+    return 'views.{}.'.format(dot2underscore(viewname))
+
+
+def read_targets(filename):
+
+    """Read fleet mode targets file: one "name host [port]" per line.
+    Blank lines and lines starting with # are ignored. Returns a
+    list of (name, host, port) tuples."""
+
+    targets = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) == 2:
+                fields.append(DEFAULT_BIND9_PORT)
+            if len(fields) != 3:
+                raise ValueError("Invalid target line: {}".format(line.strip()))
+            targets.append((dot2underscore(fields[0]), fields[1], fields[2]))
+    return targets
+
+
+LOCATION_STEP = re.compile(r"^([\w-]+)(?:\[@([\w-]+)='([^']*)'\])?$")
+
+
+def location_steps(location):
+    """Split an XML stats location into (tag, attribute, value) steps"""
+    steps = []
+    for step in location.split('/'):
+        match = LOCATION_STEP.match(step)
+        if match is None:
+            raise ValueError("Unsupported location: {}".format(location))
+        steps.append(match.groups())
+    return tuple(steps)
+
+
+def step_matches(step, elem):
+    """Does element match the given (tag, attribute, value) step?"""
+    tag, attr, value = step
+    if elem.tag != tag:
+        return False
+    return attr is None or elem.get(attr) == value
+
+
+def remove_child(parent, elem):
+    """Remove elem from parent, searching from the end (where the
+    elements just closed by iterparse are)"""
+    for i in range(len(parent) - 1, -1, -1):
+        if parent[i] is elem:
+            del parent[i]
+            return
+
+
+def stream_etree_root(source, paths, handlers=None):
+
+    """Incrementally parse XML statistics from source with iterparse,
+    keeping only elements at or below the given paths (sequences of
+    location steps, relative to the root element). Everything else is
+    discarded as soon as it has been parsed, so memory use is bounded
+    by the size of the wanted sections, not the size of the document.
+    If handlers (a dict of location: callback) is given, each element
+    at one of those locations is passed to callback(elem, ancestors)
+    as soon as it has been parsed, and then discarded too; ancestors
+    is the tuple of its ancestor elements, starting with the root.
+    Returns the root of the pruned ElementTree."""
+
+    handlers = {location_steps(x): callback
+                for (x, callback) in (handlers or {}).items()}
+    paths = list(paths) + list(handlers)
+    root = None
+    stack = []                 # (element, candidate paths, keep, handler)
+    for event, elem in et.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+                stack.append((elem, paths, False, None))
+                continue
+            _, candidates, keep, _ = stack[-1]
+            handler = None
+            if not keep and candidates:
+                depth = len(stack) - 1
+                candidates = [p for p in candidates
+                              if step_matches(p[depth], elem)]
+                for p in candidates:
+                    if len(p) == depth + 1:
+                        keep = True
+                        handler = handlers.get(p, handler)
+            stack.append((elem, candidates, keep, handler))
+        else:
+            _, candidates, keep, handler = stack.pop()
+            if not stack:
+                continue
+            parent = stack[-1][0]
+            if handler is not None:
+                handler(elem, tuple(x[0] for x in stack))
+            elif keep or any(p not in handlers for p in candidates):
+                continue
+            elem.clear()
+            remove_child(parent, elem)
+    return root
+
+
+def apply_handlers(root, handlers):
+    """Pass each element of a parsed tree at one of the handler
+    locations to callback(elem, ancestors) and remove it, as
+    stream_etree_root() does while parsing"""
+    for (location, callback) in handlers.items():
+        steps = location.split('/')
+        chains = [(root,)]
+        for step in steps[:-1]:
+            chains = [chain + (elem,)
+                      for chain in chains for elem in chain[-1].iterfind(step)]
+        for chain in chains:
+            parent = chain[-1]
+            found = parent.findall(steps[-1])
+            for elem in found:
+                callback(elem, chain)
+            # delete from the end, as remove() of each of thousands of
+            # siblings (memory contexts) would take quadratic time
+            found = set(map(id, found))
+            for i in range(len(parent) - 1, -1, -1):
+                if id(parent[i]) in found:
+                    del parent[i]
+
+
+def merge_etree(dest, src):
+
+    """Merge the children of ElementTree element src into dest. Elements
+    with the same tag and attributes are merged recursively, so that
+    e.g. the server sections of /xml/v3/server and /xml/v3/net end up
+    as one server element. Duplicate leaf elements are dropped."""
+
+    index = {}
+    for child in dest:
+        index[(child.tag, tuple(sorted(child.attrib.items())))] = child
+    for child in list(src):
+        key = (child.tag, tuple(sorted(child.attrib.items())))
+        if key not in index:
+            dest.append(child)
+            index[key] = child
+        elif len(child):
+            merge_etree(index[key], child)
+
+
+class StatsNotFound(Exception):
+    """Statistics resource does not exist on the server"""
+
+
+def add_counters(parent, ctype, counters):
+    """Add a counters element of the given type with counter children
+    for a JSON statistics counter object"""
+    if not counters:
+        return
+    element = et.SubElement(parent, 'counters', type=ctype)
+    for (name, value) in counters.items():
+        et.SubElement(element, 'counter', name=name).text = str(value)
+
+
+def json_to_etree(stats, zone_counters=False, memory_contexts=False):
+
+    """Convert JSON (v1) statistics into an ElementTree with the same
+    layout as the XML (v3) statistics, so that the locations used by
+    Graphs.params work unchanged for both formats. Per-zone counters
+    and memory contexts are not used by the params, and so are only
+    converted if zone_counters and memory_contexts are True; and then
+    only the MEMORY_CONTEXT_FIELDS of contexts."""
+
+    root = et.Element('statistics',
+                      version=str(stats.get('json-stats-version', '')))
+
+    server = et.SubElement(root, 'server')
+    for field in ('boot-time', 'config-time', 'current-time', 'version'):
+        if field in stats:
+            et.SubElement(server, field).text = str(stats[field])
+    for (member, ctype) in JSON_SERVER_COUNTERS:
+        add_counters(server, ctype, stats.get(member))
+
+    views = et.SubElement(root, 'views')
+    for (viewname, viewdata) in stats.get('views', {}).items():
+        view = et.SubElement(views, 'view', name=viewname)
+        if 'zones' in viewdata:
+            zones = et.SubElement(view, 'zones')
+            for zonedata in viewdata['zones']:
+                zone = et.SubElement(zones, 'zone', name=zonedata['name'],
+                                     rdataclass=zonedata.get('class', 'IN'))
+                et.SubElement(zone, 'type').text = zonedata.get('type', '')
+                et.SubElement(zone, 'serial').text = str(
+                    zonedata.get('serial', ''))
+                if zone_counters:
+                    add_counters(zone, 'rcode', zonedata.get('rcodes'))
+                    add_counters(zone, 'qtype', zonedata.get('qtypes'))
+        resolver = viewdata.get('resolver', {})
+        for (member, ctype) in JSON_RESOLVER_COUNTERS:
+            add_counters(view, ctype, resolver.get(member))
+        if 'cache' in resolver:
+            cache = et.SubElement(view, 'cache', name=viewname)
+            for (rrtype, count) in resolver['cache'].items():
+                rrset = et.SubElement(cache, 'rrset')
+                et.SubElement(rrset, 'name').text = rrtype
+                et.SubElement(rrset, 'counter').text = str(count)
+
+    if 'memory' in stats:
+        memory = et.SubElement(root, 'memory')
+        if memory_contexts:
+            contexts = et.SubElement(memory, 'contexts')
+            for contextdata in stats['memory'].get('contexts', []):
+                context = et.SubElement(contexts, 'context')
+                for field in MEMORY_CONTEXT_FIELDS:
+                    if field in contextdata:
+                        et.SubElement(context, field).text = str(
+                            contextdata[field])
+        summary = et.SubElement(memory, 'summary')
+        for (field, value) in stats['memory'].items():
+            if field != 'contexts':
+                et.SubElement(summary, field).text = str(value)
+
+    return root
+
+
+class StatsConnection:
+
+    """Persistent HTTP/1.1 (keep-alive) connection to a BIND9 statistics
+    channel. The connection is re-established transparently if the
+    server has closed it or it has otherwise failed. If compress is
+    True, compressed responses are asked for."""
+
+    def __init__(self, host, port, timeout, compress=False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.headers = {'Accept-Encoding': 'deflate, gzip'} if compress else {}
+        self.conn = None
+        self.requests = 0              # total requests sent
+        self.reused = 0                # requests sent on an existing connection
+        self.connects = 0              # TCP connections made
+        self.wait_time = 0.0           # total time waiting for responses
+        self.wire_bytes = 0            # total response body bytes received
+        self.document_bytes = 0        # total of those bytes decompressed
+
+    def url(self, path):
+        """Return URL for the given path, for messages"""
+        return "http://{}:{}{}".format(self.host, self.port, path)
+
+    def close(self):
+        """Close the connection"""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get(self, path):
+
+        """Send a GET request for path and return the response. If an
+        existing connection turns out to be unusable, retry once on a
+        new connection."""
+
+        while True:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port,
+                                                       timeout=self.timeout)
+            reused = self.conn.sock is not None
+            if not reused:
+                self.connects += 1
+            time_start = time.time()
+            try:
+                self.conn.request('GET', path, headers=self.headers)
+                response = self.conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if reused:
+                    continue
+                raise
+            finally:
+                self.wait_time += time.time() - time_start
+            self.requests += 1
+            if reused:
+                self.reused += 1
+            return response
+
+
+class ResponseReader:
+
+    """File-like reader of a statistics response body, which counts the
+    bytes received on the connection, and decompresses a deflate or
+    gzip encoded body as it is read, so that it can be parsed while it
+    arrives, without holding the compressed or whole document"""
+
+    chunk_size = 65536
+
+    def __init__(self, response, conn):
+        self.response = response
+        self.conn = conn
+        self.decompressor = None
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        if encoding in ('deflate', 'gzip', 'x-gzip'):
+            # zlib or gzip header, detected automatically
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    def receive(self, size):
+        """Read up to size bytes of the body (all of it if size is
+        None), and count them"""
+        data = self.response.read(size)
+        self.conn.wire_bytes += len(data)
+        return data
+
+    def read(self, size=-1):
+        """Read up to size bytes of the (decompressed) document, or
+        all of the rest if size is negative"""
+
+        if size is None or size < 0:
+            size = None
+        decompressor = self.decompressor
+        if decompressor is None:
+            data = self.receive(size)
+        elif size is None:
+            data = decompressor.decompress(
+                decompressor.unconsumed_tail + self.receive(None))
+            data += decompressor.flush()
+        else:
+            # at most size bytes, leaving the rest of the input for
+            # the next read; only an empty result means end of data
+            data = b''
+            while not data:
+                compressed = decompressor.unconsumed_tail
+                if not compressed:
+                    compressed = self.receive(self.chunk_size)
+                    if not compressed:
+                        data = decompressor.flush()
+                        break
+                data = decompressor.decompress(compressed, size)
+        self.conn.document_bytes += len(data)
+        return data
+
+
+def open_stats_url(conn, path, optional=False):
+
+    """Request path on the statistics channel connection and return a
+    reader of the response (see ResponseReader), or None on error. If
+    optional is True, a 404 response raises StatsNotFound."""
+
+    try:
+        response = conn.get(path)
+    except (http.client.HTTPException, OSError) as einfo:
+        log_message("ERROR: Error reading {}: {}".format(conn.url(path), einfo))
+        return None
+    if response.status == 200:
+        return ResponseReader(response, conn)
+    response.read()
+    if optional and response.status == 404:
+        raise StatsNotFound(conn.url(path))
+    log_message("ERROR: Error reading {}: HTTP {} {}".format(
+        conn.url(path), response.status, response.reason))
+    return None
+
+
+def get_json_etree_root(conn, path, paths=None, optional=False,
+                        handlers=None):
+
+    """Return the root of an ElementTree structure populated from
+    JSON statistics obtained from path on the given connection, and
+    the elapsed time. The paths argument is ignored, since JSON is
+    not stream parsed. Per-zone counters and memory contexts are only
+    converted if they have a handler."""
+
+    time_start = time.time()
+    rawdata = open_stats_url(conn, path, optional)
+    if rawdata is None:
+        return None, None
+    handled = handlers or {}
+    outdata = json_to_etree(
+        json.load(rawdata),
+        zone_counters=any(x.startswith('views/') for x in handled),
+        memory_contexts=any(x.startswith('memory/') for x in handled))
+    if handlers:
+        apply_handlers(outdata, handlers)
+    elapsed = time.time() - time_start
+    return outdata, elapsed
+
+
+def get_xml_etree_root(conn, path, paths=None, optional=False,
+                       handlers=None):
 
     """Return the root of an ElementTree structure populated by
-    parsing XML statistics obtained at the given URL. And also
-    the elapsed time."""
+    parsing XML statistics obtained from path on the given connection.
+    And also the elapsed time. If paths is given, the statistics are
+    stream parsed and only those paths are kept. If optional is
+    True, a 404 response raises StatsNotFound. Elements at the
+    locations of handlers are passed to them (see stream_etree_root)."""
 
     time_start = time.time()
-    try:
-        rawdata = urlopen(url, timeout=timeout)
-    except URLError as einfo:
-        log_message("ERROR: Error reading {}: {}".format(url, einfo))
+    rawdata = open_stats_url(conn, path, optional)
+    if rawdata is None:
         return None, None
-    outdata = et.parse(rawdata).getroot()
+    if paths is None:
+        outdata = et.parse(rawdata).getroot()
+        if handlers:
+            apply_handlers(outdata, handlers)
+    else:
+        outdata = stream_etree_root(rawdata, paths, handlers)
     elapsed = time.time() - time_start
     return outdata, elapsed
 
@@ -341,14 +988,44 @@ class Bind9Stats:
 
     """Class to poll BIND9 Statistics server and parse its data"""
 
-    def __init__(self, host, port, timeout, poll_interval=60):
+    def __init__(self, host, port, timeout, poll_interval=60, paths=None,
+                 resources=None, stats_type='xml', zone_counters=None,
+                 compress=False, memory_contexts=None, top_contexts=10,
+                 context_growth=False):
         self.host = host
         self.port = port
         self.timeout = timeout
         self.poll_interval = poll_interval
-        self.url = "http://{}:{}/xml".format(host, port)
+        self.paths = paths
+        self.resources = resources     # None: fetch the whole document
+        self.stats_type = stats_type
+        self.path = "/{}".format(stats_type)
+        self.conn = StatsConnection(host, port, timeout, compress)
+        self.http_requests = 0         # requests made by last poll
+        self.http_reused = 0           # of which on a kept-alive connection
+        self.wire_bytes = 0            # response bytes received by last poll
+        self.document_bytes = 0        # the same, decompressed
+        self.zone_counters = []        # (view, zone, [(type, names, values)])
+        self.counter_names = {}        # interned tuples of counter names
+        self.top_contexts = top_contexts
+        self.context_growth = context_growth
+        self.memory_contexts = []      # heap of (key, id, name, inuse, growth)
+        self.context_inuse = None      # id -> inuse at the last poll
+        self.context_inuse_next = {}   # the same, for this poll
+        self.handlers = None
+        if zone_counters is not None:
+            self.handlers = {zone_counters: self.add_zone_counters}
+        if memory_contexts is not None:
+            self.handlers = self.handlers or {}
+            self.handlers[memory_contexts] = self.add_memory_context
+        if stats_type == 'json':
+            self.get_etree_root = get_json_etree_root
+        else:
+            self.get_etree_root = get_xml_etree_root
         self.tree = None
         self.poll_duration = None
+        self.fetch_latency = None      # time till the response headers
+        self.parse_time = None         # rest of poll_duration
         self.timestamp = None
         self.g_timestamp = None
         self.g_timestamp_last = None
@@ -356,15 +1033,122 @@ class Bind9Stats:
         self.last_poll = None
         self.time_delta = None
 
-    def poll(self):
-        """Poll BIND stats and record timestamp and time delta"""
+    def poll(self, slot=None, sample=False):
+        """Poll BIND stats and record timestamp and time delta. slot is
+        the graphite timestamp given by the scheduler; without it, the
+        graphite timestamp is computed from the time of the poll,
+        except for intermediate samples, whose data is not sent. Nor
+        do samples move the baseline of memory context growth."""
         self.timestamp = time.time()
-        self.compute_graphite_timestamp()
-        self.tree, self.poll_duration = get_xml_etree_root(self.url, self.timeout)
+        if slot is not None:
+            self.g_timestamp = self.g_timestamp_last = slot
+        elif not sample:
+            self.compute_graphite_timestamp()
+        requests, reused = self.conn.requests, self.conn.reused
+        wait_time = self.conn.wait_time
+        wire_bytes = self.conn.wire_bytes
+        document_bytes = self.conn.document_bytes
+        self.clear_handled()
+        self.tree, self.poll_duration = self.fetch()
+        self.http_requests = self.conn.requests - requests
+        self.http_reused = self.conn.reused - reused
+        self.fetch_latency = self.conn.wait_time - wait_time
+        self.wire_bytes = self.conn.wire_bytes - wire_bytes
+        self.document_bytes = self.conn.document_bytes - document_bytes
+        self.parse_time = None
+        if self.poll_duration is not None:
+            self.parse_time = max(0.0, self.poll_duration - self.fetch_latency)
         if self.tree is not None:
             if self.last_poll is not None:
                 self.time_delta = self.timestamp - self.last_poll
             self.last_poll = self.timestamp
+            self.memory_contexts.sort(reverse=True)
+            if self.context_growth and not sample:
+                self.context_inuse = self.context_inuse_next
+
+    def fetch(self):
+        """Fetch and parse statistics, either the whole document or just
+        the needed sub-resources merged into one tree"""
+
+        if self.resources is None:
+            return self.get_etree_root(self.conn, self.path, self.paths,
+                                       handlers=self.handlers)
+
+        time_start = time.time()
+        root = None
+        try:
+            for resource in self.resources:
+                path = "{}/{}/{}".format(self.path,
+                                         STATS_VERSIONS[self.stats_type],
+                                         resource)
+                subtree, _ = self.get_etree_root(self.conn, path,
+                                                 self.paths, optional=True,
+                                                 handlers=self.handlers)
+                if subtree is None:
+                    return None, None
+                if root is None:
+                    root = subtree
+                else:
+                    merge_etree(root, subtree)
+        except StatsNotFound as einfo:
+            log_message("WARN: {} not found, falling back to {}".format(
+                einfo, self.conn.url(self.path)))
+            self.resources = None
+            self.clear_handled()
+            return self.fetch()
+        return root, time.time() - time_start
+
+    def clear_handled(self):
+        """Forget the data recorded by the handlers during a poll"""
+        self.zone_counters = []
+        self.memory_contexts = []
+        self.context_inuse_next = {}
+
+    def add_zone_counters(self, counters, ancestors):
+        """Record the values of a per-zone counters element (called
+        while the zones statistics are parsed). Counter names are
+        shared between zones, and values are kept in an integer array,
+        so that tens of thousands of zones take little memory."""
+
+        ctype = counters.get('type')
+        if ctype not in ZONE_COUNTER_TYPES:
+            return
+        names = tuple([c.get('name') for c in counters])
+        names = self.counter_names.setdefault(names, names)
+        values = array('q', [int(c.text) for c in counters])
+        viewname = ancestors[-3].get('name')
+        zonename = ancestors[-1].get('name')
+        last = self.zone_counters[-1] if self.zone_counters else None
+        if last and last[1] == zonename and last[0] == viewname:
+            last[2].append((ctype, names, values))
+        else:
+            self.zone_counters.append(
+                (viewname, zonename, [(ctype, names, values)]))
+
+    def add_memory_context(self, context, ancestors):
+        """Consider a memory context (called while the memory statistics
+        are parsed) for the top_contexts by bytes in use, or with
+        context_growth, by growth since the last poll that was not an
+        intermediate sample (see poll()). The top contexts are kept in a
+        bounded heap, so that tens of thousands of contexts take little
+        memory and time. memory_contexts is sorted largest first at the
+        end of the poll."""
+
+        ctxid = context.findtext('id')
+        inuse = int(context.findtext('inuse') or 0)
+        growth = None
+        if self.context_growth:
+            self.context_inuse_next[ctxid] = inuse
+            if self.context_inuse is None:
+                return
+            # contexts created since the last poll grew from nothing
+            growth = inuse - self.context_inuse.get(ctxid, 0)
+        entry = (inuse if growth is None else growth, ctxid,
+                 context.findtext('name') or '', inuse, growth)
+        if len(self.memory_contexts) < self.top_contexts:
+            heapq.heappush(self.memory_contexts, entry)
+        elif entry > self.memory_contexts[0]:
+            heapq.heapreplace(self.memory_contexts, entry)
 
     def compute_graphite_timestamp(self):
         """Graphite timestamp computation function"""
@@ -398,19 +1182,22 @@ class Bind9Stats:
         except ValueError:
             return 'nan'
 
-    def getdata(self, graphconfig):
-        """Obtain data from XML stats location"""
+    def getdata(self, graphconfig, element=None):
+        """Obtain data from XML stats location, relative to element
+        (e.g. a view), or to the root of the statistics"""
 
         stattype = graphconfig['stattype']
         location = graphconfig['location']
+        if element is None:
+            element = self.tree
 
         if stattype == 'memory':
-            return self.getdata_memory(graphconfig)
+            return self.getdata_memory(graphconfig, element)
         elif stattype == 'cachedb':
-            return self.getdata_cachedb(graphconfig)
+            return self.getdata_cachedb(graphconfig, element)
 
         results = []
-        counters = self.tree.findall(location)
+        counters = element.findall(location)
 
         if counters is None:
             return results
@@ -421,13 +1208,13 @@ class Bind9Stats:
             results.append((key, val))
         return results
 
-    def getdata_memory(self, graphconfig):
+    def getdata_memory(self, graphconfig, element):
         """Obtain memory type XML stats"""
 
         location = graphconfig['location']
 
         results = []
-        counters = self.tree.find(location)
+        counters = element.find(location)
 
         if counters is None:
             return results
@@ -438,13 +1225,13 @@ class Bind9Stats:
             results.append((key, val))
         return results
 
-    def getdata_cachedb(self, graphconfig):
+    def getdata_cachedb(self, graphconfig, element):
         """Obtain cachedb type XML stats"""
 
         location = graphconfig['location']
 
         results = []
-        counters = self.tree.findall(location)
+        counters = element.findall(location)
 
         if counters is None:
             return results
@@ -456,45 +1243,733 @@ class Bind9Stats:
         return results
 
 
+def plaintext_payload(datapoints, timestamp, prefixes=None):
+
+    """Format (metricpath, value) datapoints in Graphite's plaintext
+    protocol, into a single buffer. prefixes is an optional dictionary
+    in which the encoded "metricpath " line prefixes are kept across
+    calls, so they are only built once per metric."""
+
+    if prefixes is None:
+        prefixes = {}
+    suffix = ' {}\r\n'.format(timestamp).encode()
+    payload = bytearray()
+    for (path, value) in datapoints:
+        prefix = prefixes.get(path)
+        if prefix is None:
+            prefix = prefixes[path] = (path + ' ').encode()
+        payload += prefix
+        payload += str(value).encode()
+        payload += suffix
+    return payload
+
+
+class Spool:
+
+    """Bounded on-disk spool for payloads that could not be sent to
+    Graphite. Payloads are appended, as they were encoded (and so with
+    their original timestamps), to segment files in the spool directory
+    and are replayed oldest first. When the total size exceeds max_bytes
+    the oldest segments are dropped, and records older than max_age
+    seconds are dropped rather than replayed. Replay is at-least-once:
+    after a restart, the oldest segment is replayed from its start,
+    which Graphite tolerates since it keeps the last value written.
+    Appending and replaying may be done from different threads."""
+
+    HEADER = struct.Struct('!qL')      # record: spool time, payload length
+
+    def __init__(self, directory, suffix, max_bytes, max_age):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.suffix = '.' + suffix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_size = max(max_bytes // 8, 1)
+        self.writer = None             # segment file being appended to
+        self.offset = 0                # replay position in oldest segment
+        self.sequence = 0
+        self.lock = threading.Lock()   # held by append() and replay()
+
+    def segments(self):
+        """Return list of segment file paths, oldest first"""
+        return [os.path.join(self.directory, x)
+                for x in sorted(os.listdir(self.directory))
+                if x.endswith(self.suffix)]
+
+    def remove_segment(self, path):
+        """Remove a segment file, resetting the replay position if it was
+        the oldest one, and closing it if it was being appended to"""
+        if self.writer is not None and self.writer.name == path:
+            self.writer.close()
+            self.writer = None
+        segments = self.segments()
+        if segments and segments[0] == path:
+            self.offset = 0
+        os.remove(path)
+
+    def enforce_limits(self):
+        """Drop the oldest segments over the size or age limit"""
+        segments = self.segments()
+        sizes = [os.path.getsize(x) for x in segments]
+        total = sum(sizes)
+        cutoff = time.time() - self.max_age
+        for (path, size) in zip(segments[:-1], sizes):
+            if total <= self.max_bytes and os.path.getmtime(path) >= cutoff:
+                break
+            log_message("WARN: spool limit reached, dropping {}".format(path))
+            self.remove_segment(path)
+            total -= size
+
+    def append(self, data):
+        """Append a payload to the spool"""
+        with self.lock:
+            self.append_locked(data)
+
+    def append_locked(self, data):
+        """Append a payload to the spool, with the lock held"""
+        if self.writer is None or self.writer.tell() >= self.segment_size:
+            if self.writer is not None:
+                self.writer.close()
+            self.sequence += 1
+            path = os.path.join(self.directory, "{:012d}.{:06d}{}".format(
+                int(time.time()), self.sequence, self.suffix))
+            self.writer = open(path, 'ab')
+        self.writer.write(self.HEADER.pack(int(time.time()), len(data)))
+        self.writer.write(data)
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.enforce_limits()
+
+    def next_record(self):
+        """Return (spool time, payload) of the oldest unsent record, or
+        None if the spool is empty. Removes fully replayed segments."""
+        while True:
+            segments = self.segments()
+            if not segments:
+                return None
+            with open(segments[0], 'rb') as f:
+                f.seek(self.offset)
+                header = f.read(self.HEADER.size)
+                if len(header) == self.HEADER.size:
+                    (spooltime, length) = self.HEADER.unpack(header)
+                    data = f.read(length)
+                    if len(data) == length:
+                        return spooltime, data
+            if len(segments) == 1 and self.writer is not None:
+                if self.writer.tell() > self.offset:
+                    return None        # partially written record
+            self.remove_segment(segments[0])
+
+    def replay(self, transmit, budget):
+        """Replay spooled payloads with transmit(data) until budget bytes
+        have been sent, the spool is empty, or transmit fails"""
+        with self.lock:
+            self.replay_locked(transmit, budget)
+
+    def replay_locked(self, transmit, budget):
+        """Replay spooled payloads, with the lock held"""
+        sent = 0
+        cutoff = time.time() - self.max_age
+        while sent < budget:
+            record = self.next_record()
+            if record is None:
+                return
+            (spooltime, data) = record
+            if spooltime >= cutoff:
+                if not transmit(data):
+                    return
+                sent += len(data)
+            self.offset += self.HEADER.size + len(data)
+
+
+class GraphiteSender:
+
+    """Connection to a Graphite server, which may be shared by several
+    Bind2Graphite instances. Uses the plaintext protocol. If a spool is
+    given, payloads that cannot be sent are spooled, and replayed (up to
+    replay_budget bytes per send) once sending works again."""
+
+    protocol = 'plaintext'
+
+    def __init__(self, host, port, timeout=5, spool=None,
+                 replay_budget=512*1024):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.socket = None
+        self.spool = spool
+        self.replay_budget = replay_budget
+        self.prefixes = {}             # metric path -> encoded line prefix
+        self.connects = 0              # connection attempts
+
+    def encode(self, datapoints, timestamp, cache=True):
+        """Encode (metricpath, value) datapoints for sending. Their
+        encoded paths are kept for later calls unless cache is False,
+        which is for paths that seldom recur"""
+        return plaintext_payload(datapoints, timestamp,
+                                 self.prefixes if cache else None)
+
+    def connect(self):
+        """Connect to Graphite server and record socket info"""
+        self.connects += 1
+        self.socket = connect_host(self.host, self.port, self.timeout)
+
+    def transmit(self, data):
+        """Send metrics data to Graphite server, reconnecting once if
+        needed. Returns True if the data was sent"""
+
+        if self.socket is None:
+            self.connect()
+        if self.socket is None:
+            return False
+        if not send_socket(self.socket, data):
+            log_message("WARN: reconnecting socket ..")
+            self.socket.close()
+            time.sleep(0.2)
+            self.connect()
+            if self.socket is None:
+                return False
+            if not send_socket(self.socket, data):
+                log_message("WARN: send() failed.")
+                self.socket.close()
+                self.socket = None
+                return False
+        return True
+
+    def replay_transmit(self, data):
+        """Send spooled data on the current connection, without retries"""
+        if send_socket(self.socket, data):
+            return True
+        self.socket.close()
+        self.socket = None
+        return False
+
+    def debug_info(self):
+        """Return sender status for debug messages"""
+        return ""
+
+    def send(self, data):
+        """Send metrics data to Graphite server, spooling it if that
+        fails, or replaying earlier spooled data if it succeeds.
+        Returns True if the data was sent"""
+
+        if self.transmit(data):
+            if self.spool is not None:
+                self.spool.replay(self.replay_transmit, self.replay_budget)
+            return True
+        if self.spool is None:
+            log_message("WARN: Sleeping till next poll.")
+        else:
+            log_message("WARN: spooling {} bytes.".format(len(data)))
+            self.spool.append(data)
+        return False
+
+
+class PickleSender(GraphiteSender):
+
+    """Connection to a Graphite server using the pickle protocol:
+    length-prefixed pickled lists of (metricpath, (timestamp, value))
+    tuples, at most batch_size datapoints per message."""
+
+    protocol = 'pickle'
+
+    def __init__(self, host, port, timeout=5, spool=None,
+                 replay_budget=512*1024, batch_size=500):
+        super().__init__(host, port, timeout, spool, replay_budget)
+        self.batch_size = batch_size
+
+    def encode(self, datapoints, timestamp, cache=True):
+        """Encode (metricpath, value) datapoints for sending (nothing
+        is cached)"""
+        messages = []
+        for i in range(0, len(datapoints), self.batch_size):
+            batch = [(path, (timestamp, float(value)))
+                     for (path, value) in datapoints[i:i+self.batch_size]]
+            payload = pickle.dumps(batch, protocol=2)
+            messages.append(struct.pack('!L', len(payload)))
+            messages.append(payload)
+        return b''.join(messages)
+
+
+class SenderQueue:
+
+    """Send metrics data from a background thread, fed through a bounded
+    queue, so that slow or failing sends do not delay polling. If the
+    queue is full, the new data is spooled if the sender has a spool,
+    and otherwise dropped and counted."""
+
+    def __init__(self, sender, maxsize):
+        self.sender = sender
+        self.queue = queue.Queue(maxsize)
+        self.maxsize = maxsize
+        self.sent = 0
+        self.failed = 0
+        self.spooled = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def connects(self):
+        """Connections made by the underlying sender"""
+        return self.sender.connects
+
+    def encode(self, datapoints, timestamp, cache=True):
+        """Encode (metricpath, value) datapoints for sending"""
+        return self.sender.encode(datapoints, timestamp, cache)
+
+    def debug_info(self):
+        """Return queue status for debug messages"""
+        return " queue={}/{} sent={} failed={} spooled={} dropped={}".format(
+            self.queue.qsize(), self.maxsize,
+            self.sent, self.failed, self.spooled, self.dropped)
+
+    def send(self, data):
+        """Queue metrics data for sending. Returns False if the queue
+        was full and the data was spooled or dropped"""
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            spool = self.sender.spool
+            if spool is not None:
+                log_message("WARN: send queue full, spooling {} bytes.".format(
+                    len(data)))
+                try:
+                    spool.append(data)
+                except OSError as einfo:
+                    log_message("ERROR: spooling failed: {}".format(einfo))
+                else:
+                    self.spooled += 1
+                    return False
+            else:
+                log_message("WARN: send queue full, dropping {} bytes.".format(
+                    len(data)))
+            self.dropped += 1
+            return False
+        return True
+
+    def run(self):
+        """Sender thread: send queued data until the program exits. An
+        exception while sending is logged, and the data counted as
+        failed, so that it does not stop the thread"""
+        while True:
+            data = self.queue.get()
+            try:
+                sent = self.sender.send(data)
+            except Exception as einfo:
+                log_message("ERROR: sending to Graphite failed: {!r}".format(
+                    einfo))
+                sent = False
+            if sent:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+
+def prometheus_escape(value):
+    """Escape a Prometheus label value"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_sample(family, labels, value):
+    """Format a Prometheus exposition line. labels is a pre-formatted
+    label string, e.g. 'server="ns1",stat="A"'"""
+    if value == 'nan':
+        value = 'NaN'
+    return '{}{{{}}} {}\n'.format(family, labels, value)
+
+
+def add_prometheus_sample(families, family, mtype, labels, value):
+    """Add a sample to a dict of metric family -> (type, sample lines)"""
+    if family not in families:
+        families[family] = (mtype, [])
+    families[family][1].append(prometheus_sample(family, labels, value))
+
+
+def accepts_gzip(accept_encoding):
+    """Return True if an Accept-Encoding header value allows a gzip
+    response: gzip (or x-gzip), failing that *, is listed with a
+    quality (q) above 0"""
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    """Serve the pre-rendered Prometheus exposition of the exporter"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Return /metrics, gzip compressed if the client accepts it"""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        compressed = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        body = self.server.exporter.body(compressed)
+        self.send_response(200)
+        self.send_header('Content-Type', PrometheusExporter.content_type)
+        if compressed:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log every scrape"""
+        return
+
+
+class PrometheusExporter:
+
+    """Prometheus pull-mode exporter. After each poll of a BIND server,
+    its metric families are handed to update(); the exposition body is
+    rendered (and gzip compressed) at most once after each update, by
+    the first scrape that needs it, and then served from memory. So
+    scrapes never cause fetches from the name servers, however many
+    scrapers there are and however often they come."""
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, address, port):
+        self.lock = threading.Lock()
+        self.targets = {}              # server name -> metric families
+        self.rendered = None           # (body, gzip compressed body)
+        self.scrapes = 0
+        self.renders = 0
+        self.server = http.server.ThreadingHTTPServer((address, port),
+                                                      MetricsHandler)
+        self.server.daemon_threads = True
+        self.server.exporter = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def update(self, name, families):
+        """Replace a server's metric families, a list of (family, type,
+        samples text) tuples"""
+        with self.lock:
+            self.targets[name] = families
+            self.rendered = None
+
+    def render(self):
+        """Render the exposition body, with the samples of each metric
+        family from all the servers grouped together"""
+        table = {}
+        for families in self.targets.values():
+            for (family, mtype, samples) in families:
+                if family not in table:
+                    table[family] = (mtype, [])
+                table[family][1].append(samples)
+        self.renders += 1
+        return ''.join('# TYPE {} {}\n{}'.format(family, mtype, ''.join(samples))
+                       for (family, (mtype, samples)) in table.items()).encode()
+
+    def body(self, compressed=False):
+        """Return the exposition body, rendering it if needed"""
+        with self.lock:
+            self.scrapes += 1
+            if self.rendered is None:
+                self.rendered = (self.render(), None)
+            if not compressed:
+                return self.rendered[0]
+            if self.rendered[1] is None:
+                self.rendered = (self.rendered[0],
+                                 gzip.compress(self.rendered[0], 6))
+            return self.rendered[1]
+
+    def debug_info(self):
+        """Return scrape statistics for debug messages"""
+        return " scrapes={} renders={}".format(self.scrapes, self.renders)
+
+
+class DeriveStore:
+
+    """Previous values of DERIVE metrics. Each metric, identified by
+    its (category, stat) key, is assigned a slot the first time it is
+    seen, when its graphite path is formatted and kept in a list indexed
+    by slot; previous values are kept as floats in a typed array indexed
+    by slot. The counters read in a run are queued with add(), by slot,
+    and turned into rates at the end of the run by compute().
+
+    With aggregate, the rates of a series of samples are instead folded
+    into running aggregates (minimum, maximum, increase, duration and
+    last rate, in arrays indexed by slot) by accumulate(), returned by
+    aggregate() and started afresh by restart()."""
+
+    def __init__(self, aggregate=False):
+        self.slots = {}                # (category, stat) -> slot number
+        self.paths = []                # slot number -> metric path
+        self.previous = array('d')     # slot number -> previous value
+        self.pending_slots = array('l')
+        self.pending_values = array('d')
+        self.keys = [] if aggregate else None   # slot number -> key
+        if aggregate:
+            self.restart()
+
+    def __len__(self):
+        return len(self.previous)
+
+    def add(self, key, value, prefix):
+        """Queue a counter value for the rate computation. key is the
+        metric's (category, stat), which is returned with its
+        aggregates; its path is prefix.category.stat"""
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.previous)
+            self.paths.append('{}.{}.{}'.format(prefix, *key))
+            self.previous.append(float('nan'))
+            if self.keys is not None:
+                self.keys.append(key)
+                self.minimum.append(float('inf'))
+                self.maximum.append(float('-inf'))
+                self.increase.append(0.0)
+                self.duration.append(0.0)
+                self.last.append(float('nan'))
+        self.pending_slots.append(slot)
+        self.pending_values.append(float(value))
+
+    def compute(self, time_delta):
+        """Return (metricpath, rate) for all the queued counters, and
+        remember their values for the next run. The rate is 'nan' for
+        new metrics and for negative increments (probably a BIND server
+        restart)"""
+
+        previous = self.previous
+        paths = self.paths
+        result = []
+        if time_delta:
+            for (slot, value) in zip(self.pending_slots, self.pending_values):
+                rate = (value - previous[slot]) / time_delta
+                previous[slot] = value
+                result.append((paths[slot], rate if rate >= 0 else 'nan'))
+        else:
+            for (slot, value) in zip(self.pending_slots, self.pending_values):
+                previous[slot] = value
+                result.append((paths[slot], 'nan'))
+        del self.pending_slots[:]
+        del self.pending_values[:]
+        return result
+
+    def restart(self):
+        """Start new aggregates for all metrics"""
+        size = len(self.previous)
+        self.minimum = array('d', [float('inf')]) * size
+        self.maximum = array('d', [float('-inf')]) * size
+        self.increase = array('d', [0.0]) * size
+        self.duration = array('d', [0.0]) * size
+        self.last = array('d', [float('nan')]) * size
+
+    def accumulate(self, time_delta):
+        """Fold the rates of the queued counters into their metrics'
+        aggregates, and remember their values for the next sample.
+        Negative increments (probably a BIND server restart) are left
+        out."""
+
+        previous = self.previous
+        if time_delta:
+            minimum, maximum = self.minimum, self.maximum
+            increase, duration = self.increase, self.duration
+            last = self.last
+            for (slot, value) in zip(self.pending_slots, self.pending_values):
+                delta = value - previous[slot]
+                previous[slot] = value
+                if not delta >= 0:
+                    continue
+                rate = delta / time_delta
+                if rate < minimum[slot]:
+                    minimum[slot] = rate
+                if rate > maximum[slot]:
+                    maximum[slot] = rate
+                increase[slot] += delta
+                duration[slot] += time_delta
+                last[slot] = rate
+        else:
+            for (slot, value) in zip(self.pending_slots, self.pending_values):
+                previous[slot] = value
+        del self.pending_slots[:]
+        del self.pending_values[:]
+
+    def aggregate(self, time_delta):
+        """Accumulate the queued counters, and return (key, minimum,
+        maximum, mean, last) rates for each of them over the samples
+        since the last restart(); the mean is weighted by the sample
+        durations. Rates are 'nan' for metrics without any."""
+
+        slots = array('l', self.pending_slots)
+        self.accumulate(time_delta)
+        result = []
+        for slot in slots:
+            duration = self.duration[slot]
+            if duration:
+                result.append((self.keys[slot], self.minimum[slot],
+                               self.maximum[slot],
+                               self.increase[slot] / duration,
+                               self.last[slot]))
+            else:
+                result.append((self.keys[slot], 'nan', 'nan', 'nan', 'nan'))
+        return result
+
+
+class Scheduler:
+
+    """Schedule runs every interval seconds, at multiples of interval
+    of wall-clock time ("slots"), which serve as graphite timestamps,
+    or phase seconds after them. The deadlines (slot + phase) are
+    absolute times on the monotonic clock, so they do not drift however
+    long the runs take. A run that is due while the previous one is
+    still going is started late, but if a run overran by a whole
+    interval or more, the slots it missed are skipped rather than run
+    back to back, so that the slots (and timestamps) of the runs always
+    go up by whole intervals. The schedule is realigned if the wall
+    clock is stepped, but never to a slot that has already been run, so
+    a step back delays the next run instead. The clocks and sleep
+    function can be replaced, e.g. by fake ones for testing."""
+
+    def __init__(self, interval, phase=0, clock=time.monotonic,
+                 wallclock=time.time, sleep=time.sleep):
+        self.interval = interval
+        self.phase = phase
+        self.clock = clock
+        self.wallclock = wallclock
+        self.sleep = sleep
+        self.slot = None               # wall-clock time of the current slot
+        self.deadline = None           # monotonic time to run current slot
+        self.offset = None             # wall-clock minus monotonic time
+        self.skipped = 0               # slots skipped so far
+
+    def align(self):
+        """Schedule the next slot whose deadline is still to come"""
+        now = self.clock()
+        self.offset = self.wallclock() - now
+        self.slot = (int((now + self.offset - self.phase) // self.interval)
+                     + 1) * self.interval
+        self.deadline = self.slot + self.phase - self.offset
+
+    def wait(self):
+        """Wait until the next slot is due, and return it"""
+
+        if self.slot is None:
+            self.align()
+        else:
+            self.slot += self.interval
+            self.deadline += self.interval
+            now = self.clock()
+            if abs(self.wallclock() - now - self.offset) >= self.interval / 2:
+                log_message("WARN: wall clock stepped, realigning schedule")
+                earliest = self.slot
+                self.align()
+                if self.slot < earliest:
+                    self.deadline += earliest - self.slot
+                    self.slot = earliest
+            elif now >= self.deadline + self.interval:
+                missed = int((now - self.deadline) // self.interval)
+                log_message("WARN: run overran, skipping {} poll(s)".format(
+                    missed))
+                self.skipped += missed
+                self.slot += missed * self.interval
+                self.deadline += missed * self.interval
+
+        delay = self.deadline - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+        return self.slot
+
+
 class Bind2Graphite:
 
     """Functions to communicate BIND9 stats to a Graphite server"""
 
     def __init__(self, stats, host, port, name=None, timeout=5,
-                 poll_interval=None, debug=False):
+                 poll_interval=None, debug=False, sender=None, exporter=None,
+                 sample_interval=None, phase=0):
         self.stats = stats
         self.host = host
         self.port = port
         self.name = name
         self.timeout = timeout
         self.poll_interval = poll_interval
+        self.sample_interval = sample_interval
+        self.phase = phase             # poll phase, see poll_phase()
         self.debug = debug
-        self.statsdb = {}              # stores (derive) stats from previous run
+        # stores (derive) stats from previous run, or their aggregates
+        self.statsdb = DeriveStore(aggregate=sample_interval is not None)
+        self.datapoints = []           # (metricpath, value) for this run
+        self.uncached = []             # the same, for paths that seldom recur
+        self.metricpaths = {}          # (category, stat) -> metric path
+        self.lastsent = {}             # metric path -> last value sent
+        self.cycle = 0                 # count of runs, for full refreshes
+        self.zoneprevious = {}         # (view, zone, type) -> (names, values)
+        self.zonetime = None           # timestamp of zoneprevious
+        self.zoneprefixes = {}         # (view prefix, type, zone) -> path prefix
         self.graphite_data = b''
-        self.socket = None
+        self.scheduler = None          # Scheduler of the run loop
+        self.period = None             # polling interval being sampled
+        self.generate_time = None      # time to generate this run's data
+        self.metric_count = None       # datapoints generated this run
+        self.send_time = None          # time to encode and send last run's
+        self.send_offset = None        # time into the interval it was sent
+        self.payload_bytes = None      # size of last run's payload
+        if sender is None:
+            sender = GraphiteSender(host, port, timeout)
+        self.sender = sender
+        self.exporter = exporter
 
     def reset(self):
-        """Empty graphite_data byte string"""
+        """Empty datapoints lists and graphite_data byte string"""
+        self.datapoints = []
+        self.uncached = []
         self.graphite_data = b''
 
-    def compute_statvalue(self, name, val):
-        """Compute metric value for DERIVE types"""
-        if name not in self.statsdb:
-            gvalue = 'nan'
-        else:
-            gvalue = (float(val) - float(self.statsdb[name])) / self.stats.time_delta
-            if gvalue < 0:
-                ## negative increment. Probably BIND server restart
-                gvalue = 'nan'
-        self.statsdb[name] = val
-        return gvalue
+    def metricpath(self, category, stat):
+        """Return the (cached) graphite metric path for a statistic"""
 
-    def add_metric(self, category, stat, value):
-        """Add graphite metrics line"""
+        metricpath = self.metricpaths.get((category, stat))
+        if metricpath is None:
+            metricpath = '{}.{}.{}'.format(self.name, category, stat)
+            self.metricpaths[(category, stat)] = metricpath
+        return metricpath
 
-        metricpath = '{}.{}.{}'.format(self.name, category, stat)
-        out = '{} {} {}\r\n'.format(metricpath, value, self.stats.g_timestamp)
-        self.graphite_data += out.encode()
+    def add_metric(self, category, stat, value):
+        """Add graphite metrics datapoint"""
+        self.datapoints.append((self.metricpath(category, stat), value))
+
+    def add_derive(self, category, stat, value):
+        """Add a DERIVE datapoint; its rate is filled in by
+        generate_all_data() once all the counters have been read. Its
+        metric path is kept by statsdb rather than in metricpaths"""
+        self.statsdb.add((category, stat), value, self.name)
+
+    def suppress_unchanged(self, refresh):
+        """Drop datapoints whose value is the same as the last one sent
+        for the metric, except on every refresh'th run when all of them
+        are sent"""
+        lastsent = self.lastsent
+        if self.cycle % refresh == 0:
+            for (path, value) in self.datapoints:
+                lastsent[path] = value
+        else:
+            changed = []
+            for (path, value) in self.datapoints:
+                if lastsent.get(path) != value:
+                    lastsent[path] = value
+                    changed.append((path, value))
+            self.datapoints = changed
+        self.cycle += 1
 
     def generate_bind_data(self):
         """bind_info data: boot-time and config-time"""
@@ -507,132 +1982,768 @@ class Bind2Graphite:
                         self.stats.timestring2since(
                             self.stats.tree.find('server/config-time').text))
 
-    def generate_zone_data(self):
-        """bind zone data: zonename and serial number or delta"""
+    def views(self):
+        """Return (category prefix, view element) for each view selected
+        by the views and skipviews options, in one pass over the views
+        section"""
 
-        category = "bind_zones"
-        for zone in self.stats.tree.find("views/view[@name='_default']/zones"):
-            ztype = zone.find('type').text
-            if ztype != 'builtin':
-                zonename = dot2underscore(zone.attrib['name'])
-                zserial = zone.find('serial').text
-                statname = "{}.{}".format(category, zonename)
-                if Prefs.DERIVE:
-                    serial_increment = self.compute_statvalue(statname, zserial)
-                    self.add_metric(category, zonename, serial_increment)
-                else:
-                    self.add_metric(category, zonename, zserial)
+        result = []
+        for view in self.stats.tree.iterfind(graphs.view_location):
+            prefix = view_prefix(view.get('name'))
+            if prefix is not None:
+                result.append((prefix, view))
+        return result
 
-    def generate_graph_data(self):
-        """Generate all the graphable metrics data"""
+    def generate_zone_data(self, views):
+        """bind zone data: zonename and serial number or delta"""
 
-        for (graphname, graphconfig) in graphs.params:
-            if not graphconfig['enable']:
+        for (prefix, view) in views:
+            zones = view.find('zones')
+            if zones is None:
                 continue
-            data = self.stats.getdata(graphconfig)
-            if data is None:
+            category = prefix + "bind_zones"
+            for zone in zones:
+                ztype = zone.find('type').text
+                if ztype != 'builtin':
+                    zonename = dot2underscore(zone.attrib['name'])
+                    zserial = zone.find('serial').text
+                    if Prefs.DERIVE:
+                        self.add_derive(category, zonename, zserial)
+                    else:
+                        self.add_metric(category, zonename, zserial)
+
+    def zone_prefix(self, viewprefix, ctype, zonename):
+        """Return the (cached) metric path prefix for a zone's counters"""
+
+        prefix = self.zoneprefixes.get((viewprefix, ctype, zonename))
+        if prefix is None:
+            prefix = '{}.{}{}.{}.'.format(self.name, viewprefix,
+                                          ZONE_COUNTER_TYPES[ctype],
+                                          dot2underscore(zonename))
+            self.zoneprefixes[(viewprefix, ctype, zonename)] = prefix
+        return prefix
+
+    def generate_zonestats_data(self):
+        """Per-zone query statistics: the rcode and qtype counters of
+        each zone, or with the zonerate option, only of the zones that
+        received at least that many queries per second since the last
+        run. Rates are computed per zone from the previous run's values,
+        which are kept for every zone, emitted or not. BIND only lists
+        the counters that are not zero, so when a zone's list of names
+        changes, the previous values are matched by name, with 0 for
+        counters that were not listed."""
+
+        threshold = Prefs.ZONE_RATE
+        time_delta = None
+        if self.zonetime is not None:
+            time_delta = self.stats.timestamp - self.zonetime
+        viewprefixes = {}
+        previous = self.zoneprevious
+        current = {}
+        datapoints = self.datapoints
+        for (viewname, zonename, groups) in self.stats.zone_counters:
+            if viewname not in viewprefixes:
+                viewprefixes[viewname] = view_prefix(viewname)
+            viewprefix = viewprefixes[viewname]
+            if viewprefix is None:
                 continue
-            for (key, value) in data:
-                if not validkey(graphconfig, key):
+            lastvalues = []
+            rate = None
+            for (ctype, names, values) in groups:
+                key = (viewname, zonename, ctype)
+                last = previous.get(key)
+                current[key] = (names, values)
+                if last is None or not time_delta:
+                    lastvalues.append(None)
                     continue
-                statname = "{}.{}".format(graphname, key)
-                if Prefs.DERIVE and graphconfig['metrictype'] == 'DERIVE':
-                    gvalue = self.compute_statvalue(statname, value)
+                if last[0] is names:
+                    lastvalue = last[1]
                 else:
-                    gvalue = value
-                self.add_metric(graphname, key, gvalue)
+                    lastnames = dict(zip(last[0], last[1]))
+                    lastvalue = [lastnames.get(x, 0) for x in names]
+                lastvalues.append(lastvalue)
+                if ctype == 'qtype':
+                    rate = (sum(values) - sum(lastvalue)) / time_delta
+            if threshold and (rate is None or rate < threshold):
+                continue
+            for ((ctype, names, values), last) in zip(groups, lastvalues):
+                prefix = self.zone_prefix(viewprefix, ctype, zonename)
+                if not Prefs.DERIVE:
+                    rates = values
+                elif last is None:
+                    rates = ['nan'] * len(values)
+                else:
+                    rates = [(v - l) / time_delta if v >= l else 'nan'
+                             for (v, l) in zip(values, last)]
+                datapoints.extend(
+                    (prefix + name, value) for (name, value) in zip(names, rates))
+        self.zoneprevious = current
+        self.zonetime = self.stats.timestamp
+
+    def generate_memcontexts_data(self):
+        """Top memory contexts: the bytes in use of the contexts kept by
+        Bind9Stats.add_memory_context(), and with the memgrowth option,
+        their growth since the last poll. Context ids are memory
+        addresses, and the top contexts change from poll to poll, so
+        these go in the uncached datapoints: their metric paths are not
+        kept by the sender, nor by the onchange option, which would
+        otherwise keep every path ever sent."""
+
+        prefix = '{}.dns_memory_contexts.'.format(self.name)
+        for (_, ctxid, name, inuse, growth) in self.stats.memory_contexts:
+            path = '{}{}.{}.'.format(prefix, dot2underscore(name or 'unnamed'),
+                                     ctxid)
+            self.uncached.append((path + 'inuse', inuse))
+            if growth is not None:
+                self.uncached.append((path + 'growth', growth))
+
+    def add_graph_data(self, dispatch, element=None, prefix=''):
+        """Add the metrics of the graphs in a dispatch table, reading
+        locations relative to element (default: the statistics root),
+        with prefix prepended to the graph names"""
+
+        for (graphconfig, consumers) in dispatch:
+            data = self.stats.getdata(graphconfig, element)
+            if data is None:
+                continue
+            for (key, value) in data:
+                for (graphname, is_derive, fields) in consumers:
+                    if fields is not None and key not in fields:
+                        continue
+                    if Prefs.DERIVE and is_derive:
+                        self.add_derive(prefix + graphname, key, value)
+                    else:
+                        self.add_metric(prefix + graphname, key, value)
+
+    def generate_graph_data(self, views):
+        """Generate all the graphable metrics data, reading each
+        statistics section once and passing each counter to all the
+        graphs that want it (see Graphs.compile_dispatch). View scoped
+        graphs are generated for each selected view."""
+
+        self.add_graph_data(graphs.dispatch)
+        if graphs.view_dispatch:
+            for (prefix, view) in views:
+                self.add_graph_data(graphs.view_dispatch, view, prefix)
 
     def generate_all_data(self):
         """Generate all metrics data"""
         self.reset()
+        views = self.views()
         if graphs.metrics['bind']:
             self.generate_bind_data()
         if graphs.metrics['zone']:
-            self.generate_zone_data()
-        self.generate_graph_data()
+            self.generate_zone_data(views)
+        if graphs.metrics['zonestats']:
+            self.generate_zonestats_data()
+        if graphs.metrics['memcontexts']:
+            self.generate_memcontexts_data()
+        self.generate_graph_data(views)
+        if self.sample_interval is None:
+            self.datapoints.extend(self.statsdb.compute(self.stats.time_delta))
+        else:
+            self.add_aggregates()
 
-    def connect_graphite(self):
-        """Connect to Graphite server and record socket info"""
-        self.socket = connect_host(self.host, self.port, self.timeout)
+    def generate_sample_data(self):
+        """Fold the DERIVE metrics of an intermediate sample into their
+        aggregates (sampling mode). Per-zone query statistics are not
+        sampled; their rates are computed over the whole run."""
+        self.reset()
+        views = self.views()
+        if graphs.metrics['zone']:
+            self.generate_zone_data(views)
+        self.generate_graph_data(views)
+        self.statsdb.accumulate(self.stats.time_delta)
+        self.reset()
 
-    def send_graphite(self):
-        """Send metrics data to Graphite server"""
+    def add_aggregates(self):
+        """Add the mean rates of the DERIVE metrics over the samples
+        of this run, and their minimum, maximum and last sample rates
+        in <category>_min, _max and _last (sampling mode)"""
+        for ((category, stat), minimum, maximum, mean, last) in \
+                self.statsdb.aggregate(self.stats.time_delta):
+            self.add_metric(category, stat, mean)
+            self.add_metric(category + '_min', stat, minimum)
+            self.add_metric(category + '_max', stat, maximum)
+            self.add_metric(category + '_last', stat, last)
+
+    def exporter_stats(self):
+        """Return the exporter's own statistics for the last run, as
+        (stat, value, is_counter). Send time and payload size are those
+        of the previous run, as they are only known once its data has
+        been generated; statistics not known yet are left out."""
+        stats = self.stats
+        result = [
+            ('poll_offset', stats.timestamp - stats.g_timestamp, False),
+            ('poll_time', stats.poll_duration, False),
+            ('fetch_latency', stats.fetch_latency, False),
+            ('parse_time', stats.parse_time, False),
+            ('generate_time', self.generate_time, False),
+            ('send_time', self.send_time, False),
+            ('send_offset', self.send_offset, False),
+            ('payload_bytes', self.payload_bytes, False),
+            ('metrics', self.metric_count, False),
+            ('http_requests', stats.http_requests, False),
+            ('wire_bytes', stats.wire_bytes, False),
+            ('document_bytes', stats.document_bytes, False),
+            ('stats_connects', stats.conn.connects, True),
+            ('graphite_connects', self.sender.connects, True),
+            ('skipped_polls', self.scheduler and self.scheduler.skipped,
+             True),
+        ]
+        return [x for x in result if x[1] is not None]
 
-        if self.socket is None:
-            self.connect_graphite()
-        if self.socket is None:
-            return
-        if not send_socket(self.socket, self.graphite_data):
-            log_message("WARN: reconnecting socket ..")
-            self.socket.close()
-            time.sleep(0.2)
-            self.connect_graphite()
-            if self.socket is None:
-                return
-            if not send_socket(self.socket, self.graphite_data):
-                log_message("WARN: send() failed. Sleeping till next poll.")
+    def generate_exporter_data(self):
+        """bind9stats_exporter data: the exporter's own timings"""
+        for (stat, value, _) in self.exporter_stats():
+            if isinstance(value, float):
+                value = round(value, 6)
+            self.add_metric('bind9stats_exporter', stat, value)
 
-    def single_run(self):
-        """A single run of polling stats data and sending it out"""
-        self.stats.poll()
-        if self.stats.tree is None:
-            log_message("WARN: No statistics found. Sleeping till next poll.")
-            return
-        self.generate_all_data()
+    def prometheus_data(self):
+
+        """Return this server's metric families for the Prometheus
+        exporter, as a list of (family, type, samples text). Counters
+        (DERIVE metrics) are exported as raw values, for Prometheus to
+        compute rates from; everything else as gauges."""
+
+        server = 'server="{}"'.format(prometheus_escape(self.name))
+        families = {}
+
+        add_prometheus_sample(families, 'bind9_up', 'gauge', server, 1)
+        if graphs.metrics['bind']:
+            for stat in ('boot-time', 'config-time'):
+                add_prometheus_sample(
+                    families, 'bind9_bind_info', 'gauge',
+                    '{},stat="{}"'.format(server, stat),
+                    self.stats.timestring2since(
+                        self.stats.tree.find('server/' + stat).text))
+
+        views = [(prometheus_escape(view.get('name')), view)
+                 for (_, view) in self.views()]
+        dispatch = [(graphs.dispatch, self.stats.tree, server)]
+        if graphs.view_dispatch:
+            for (viewname, view) in views:
+                dispatch.append((graphs.view_dispatch, view,
+                                 '{},view="{}"'.format(server, viewname)))
+        for (table, element, labels) in dispatch:
+            for (graphconfig, consumers) in table:
+                data = self.stats.getdata(graphconfig, element)
+                if data is None:
+                    continue
+                for (key, value) in data:
+                    sample_labels = '{},stat="{}"'.format(
+                        labels, prometheus_escape(key))
+                    for (graphname, is_derive, fields) in consumers:
+                        if fields is not None and key not in fields:
+                            continue
+                        if is_derive:
+                            add_prometheus_sample(
+                                families, 'bind9_{}_total'.format(graphname),
+                                'counter', sample_labels, value)
+                        else:
+                            add_prometheus_sample(
+                                families, 'bind9_' + graphname,
+                                'gauge', sample_labels, value)
+
+        if graphs.metrics['zone']:
+            for (viewname, view) in views:
+                zones = view.find('zones')
+                if zones is None:
+                    continue
+                for zone in zones:
+                    if zone.find('type').text != 'builtin':
+                        add_prometheus_sample(
+                            families, 'bind9_zone_serial', 'gauge',
+                            '{},view="{}",zone="{}"'.format(
+                                server, viewname,
+                                prometheus_escape(zone.get('name'))),
+                            zone.find('serial').text)
+
+        if graphs.metrics['zonestats']:
+            for (viewname, zonename, groups) in self.stats.zone_counters:
+                if view_prefix(viewname) is None:
+                    continue
+                labels = '{},view="{}",zone="{}",stat="'.format(
+                    server, prometheus_escape(viewname),
+                    prometheus_escape(zonename))
+                for (ctype, names, values) in groups:
+                    family = 'bind9_{}_total'.format(ZONE_COUNTER_TYPES[ctype])
+                    for (name, value) in zip(names, values):
+                        add_prometheus_sample(families, family, 'counter',
+                                              labels + name + '"', value)
+
+        if graphs.metrics['memcontexts']:
+            for (_, ctxid, name, inuse, growth) in self.stats.memory_contexts:
+                labels = '{},context="{}",id="{}"'.format(
+                    server, prometheus_escape(name), prometheus_escape(ctxid))
+                add_prometheus_sample(families, 'bind9_memory_context_inuse',
+                                      'gauge', labels, inuse)
+                if growth is not None:
+                    add_prometheus_sample(
+                        families, 'bind9_memory_context_growth', 'gauge',
+                        labels, growth)
+
+        if graphs.metrics['exporter']:
+            for (stat, value, is_counter) in self.exporter_stats():
+                if is_counter:
+                    add_prometheus_sample(
+                        families, 'bind9stats_exporter_{}_total'.format(stat),
+                        'counter', server, value)
+                else:
+                    add_prometheus_sample(
+                        families, 'bind9stats_exporter_' + stat,
+                        'gauge', server, value)
+
+        return [(family, mtype, ''.join(samples))
+                for (family, (mtype, samples)) in families.items()]
+
+    def encode(self, sender=None):
+        """Encode this run's datapoints with sender (by default, our
+        own), without caching the paths of the uncached ones"""
+        if sender is None:
+            sender = self.sender
+        data = sender.encode(self.datapoints, self.stats.g_timestamp)
+        if self.uncached:
+            data += sender.encode(self.uncached, self.stats.g_timestamp,
+                                  cache=False)
+        return data
+
+    def send_graphite(self):
+        """Send metrics data to Graphite server"""
+        time_start = time.time()
+        self.graphite_data = self.encode()
+        sent = self.sender.send(self.graphite_data)
+        self.send_time = time.time() - time_start
+        self.send_offset = time.time() - self.stats.g_timestamp
+        self.payload_bytes = len(self.graphite_data)
+        return sent
+
+    def output(self):
+        """Send metrics data to Graphite and/or the Prometheus exporter,
+        or print it"""
+        if self.exporter is not None:
+            self.exporter.update(self.name, self.prometheus_data())
         if Prefs.SEND:
             self.send_graphite()
-        else:
-            print(self.graphite_data.decode())
-
-    def sleep_time(self, elapsed):
-        """Compute amount of time we have to sleep till next run"""
-        compensation_time = 0
-        if self.stats.time_delta is not None:
-            if self.stats.time_delta > self.poll_interval:
-                compensation_time = 2 * (self.stats.time_delta % self.poll_interval)
-        if elapsed <= self.poll_interval:
-            base_value = self.poll_interval - elapsed
-        else:
-            base_value = self.poll_interval - (elapsed % self.poll_interval)
-        return base_value - compensation_time
+        elif self.exporter is None:
+            print(plaintext_payload(self.datapoints + self.uncached,
+                                    self.stats.g_timestamp).decode())
+
+    def collect(self, slot=None):
+        """Poll stats data for the given scheduler slot, and generate
+        metrics. Returns True if there is data to send"""
+        self.stats.poll(slot)
+        if self.stats.tree is None:
+            log_message("WARN: {}: No statistics found. "
+                        "Sleeping till next poll.".format(self.name))
+            if self.exporter is not None:
+                self.exporter.update(self.name, [(
+                    'bind9_up', 'gauge', prometheus_sample(
+                        'bind9_up', 'server="{}"'.format(
+                            prometheus_escape(self.name)), 0))])
+            return False
+        if Prefs.SEND or self.exporter is None:
+            time_start = time.time()
+            self.generate_all_data()
+            if Prefs.ONCHANGE > 0:
+                self.suppress_unchanged(Prefs.ONCHANGE)
+            self.generate_time = time.time() - time_start
+            self.metric_count = len(self.datapoints) + len(self.uncached)
+            if graphs.metrics['exporter']:
+                self.generate_exporter_data()
+        return True
+
+    def single_run(self, slot=None):
+        """A single run of polling stats data and sending it out"""
+        if self.collect(slot):
+            self.output()
+
+    def sample(self):
+        """Poll stats data for an intermediate sample (sampling mode)"""
+        self.stats.poll(sample=True)
+        if self.stats.tree is not None:
+            self.generate_sample_data()
+
+    def timing_info(self, elapsed):
+        """Return debug string with timing info for the last run"""
+        time_delta = "{:.3f}".format(self.stats.time_delta) \
+            if self.stats.time_delta is not None else "null"
+        return "{} {:.3f} {} elapsed={:.3f} delta={} skipped={} " \
+            "http_reused={}/{} http_connects={} poll={:.3f} " \
+            "wire_bytes={} document_bytes={}{}{}".format(
+                self.stats.timestamp2string(),
+                self.stats.timestamp,
+                self.stats.g_timestamp,
+                elapsed,
+                time_delta,
+                self.scheduler.skipped if self.scheduler else 0,
+                self.stats.http_reused,
+                self.stats.http_requests,
+                self.stats.conn.connects,
+                self.stats.poll_duration or 0,
+                self.stats.wire_bytes,
+                self.stats.document_bytes,
+                self.sender.debug_info(),
+                self.exporter.debug_info() if self.exporter else "")
 
     def run(self):
-        """Run loop"""
+        """Run loop: poll every poll_interval seconds, on multiples of
+        it, which are used as graphite timestamps"""
+        if self.sample_interval is not None:
+            self.run_sampled()
+        self.scheduler = Scheduler(self.poll_interval, self.phase)
         while True:
+            slot = self.scheduler.wait()
             time_start = time.time()
-            self.single_run()
-            elapsed = time.time() - time_start
+            self.single_run(slot)
             if self.debug:
-                time_delta = "{:.3f}".format(self.stats.time_delta) \
-                    if self.stats.time_delta is not None else "null"
-                log_message("{} {:.3f} {} elapsed={:.3f} delta={} adj={}".format(
-                    self.stats.timestamp2string(),
-                    self.stats.timestamp,
-                    self.stats.g_timestamp,
-                    elapsed,
-                    time_delta,
-                    self.stats.adjust))
-                elapsed = time.time() - time_start
-            time.sleep(self.sleep_time(elapsed))
+                log_message(self.timing_info(time.time() - time_start))
+
+    def run_sampled(self):
+        """Run loop for sampling mode: poll every sample_interval
+        seconds, on multiples of it, and send the aggregated data of
+        the samples with the first one of each polling interval"""
+        self.scheduler = Scheduler(self.sample_interval,
+                                   self.phase % self.sample_interval)
+        while True:
+            slot = self.scheduler.wait()
+            time_start = time.time()
+            if self.sampled_run(slot) and self.debug:
+                log_message(self.timing_info(time.time() - time_start))
+
+    def sampled_run(self, slot):
+        """Poll for the given sample slot (sampling mode): a full run
+        for the first slot of a polling interval, otherwise a sample.
+        The aggregates are started afresh with every new interval, also
+        if its full run failed, so that they never take in the samples
+        of an earlier interval. Returns True for a full run"""
+        period = slot // self.poll_interval
+        full = self.period is not None and period != self.period
+        self.period = period
+        if not full:
+            self.sample()
+            return False
+        self.single_run(period * self.poll_interval)
+        self.statsdb.restart()
+        return True
+
+
+class Profiler:
+
+    """Profile a number of poll cycles with cProfile and tracemalloc,
+    and write ranked reports to a directory. The phases of a cycle
+    (fetching and parsing the statistics, generating the metrics,
+    rendering them for Prometheus and sending them) are wrapped and
+    profiled separately. Fleet mode is not supported: its workers would
+    run phases concurrently, while from Python 3.12 cProfile can only
+    run one profiler in the process, and tracemalloc's peak is
+    process-wide too. Once the reports are written the original methods
+    are put back, so that profiling costs nothing afterwards."""
+
+    phases = ('fetch', 'generate', 'prometheus', 'send')
+    lines = 25                         # entries per ranked list
+
+    def __init__(self, dirname, cycles):
+        self.dirname = dirname
+        self.cycles = cycles
+        self.runs = 0
+        self.run_time = 0.0
+        self.profiles = {}             # phase -> pstats.Stats
+        self.totals = {}               # phase -> [calls, secs, peak, retained]
+        self.wrapped = []              # (object, attribute, instance value)
+        self.first_snapshot = None
+
+    def wrap(self, obj, attr, function, *args):
+        """Replace method obj.attr by function(*args, method, ...)"""
+        self.wrapped.append((obj, attr, vars(obj).get(attr)))
+        setattr(obj, attr, partial(function, *args, getattr(obj, attr)))
+
+    def attach(self, target):
+        """Start profiling the single_run() cycles of a Bind2Graphite
+        target, and their phases"""
+        self.wrap(target.stats, 'get_etree_root', self.call, 'fetch')
+        self.wrap(target, 'generate_all_data', self.call, 'generate')
+        self.wrap(target, 'prometheus_data', self.call, 'prometheus')
+        self.wrap(target, 'send_graphite', self.call, 'send')
+        self.wrap(target, 'single_run', self.cycle)
+        tracemalloc.start()
+
+    def call(self, phase, method, *args, **kwargs):
+        """Call method, recording its profile, time and memory
+        allocations under phase"""
+        profile = cProfile.Profile()
+        memory_start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        time_start = time.time()
+        try:
+            return profile.runcall(method, *args, **kwargs)
+        finally:
+            elapsed = time.time() - time_start
+            memory, peak = tracemalloc.get_traced_memory()
+            self.record(phase, profile, elapsed,
+                        peak - memory_start, memory - memory_start)
+
+    def record(self, phase, profile, elapsed, peak, retained):
+        """Add the profile, time and memory use of a call to the totals
+        of phase"""
+        totals = self.totals.setdefault(phase, [0, 0.0, 0, 0])
+        totals[0] += 1
+        totals[1] += elapsed
+        totals[2] = max(totals[2], peak)
+        totals[3] += retained
+        if phase in self.profiles:
+            self.profiles[phase].add(profile)
+        else:
+            self.profiles[phase] = pstats.Stats(profile)
+
+    def cycle(self, method, *args):
+        """Run a poll cycle, and write the reports after the last one"""
+        time_start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.run_time += time.time() - time_start
+            self.runs += 1
+            if self.runs == 1:
+                self.first_snapshot = tracemalloc.take_snapshot()
+            if self.runs == self.cycles:
+                self.finish()
+
+    def finish(self):
+        """Stop profiling, put back the original methods and write
+        the reports"""
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for (obj, attr, value) in reversed(self.wrapped):
+            if value is None:
+                delattr(obj, attr)
+            else:
+                setattr(obj, attr, value)
+        prefix = os.path.join(self.dirname, "bind9stats-profile-{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            with open(prefix + ".txt", 'w') as report:
+                self.write_report(report, prefix, snapshot)
+        except OSError as einfo:
+            log_message("ERROR: writing profile reports: {}".format(einfo))
+            return
+        log_message("profile of {} cycles written to {}.txt".format(
+            self.runs, prefix))
+
+    def write_report(self, report, prefix, snapshot):
+        """Write the phase summary, and the functions and allocation
+        sites ranked by time and size. The profile of each phase is
+        also dumped to <prefix>-<phase>.prof, for pstats or other
+        profile viewers."""
+
+        report.write("{} poll cycles in {:.3f}s\n\n".format(
+            self.runs, self.run_time))
+        report.write("{:<12}{:>8}{:>12}{:>12}{:>14}{:>14}\n".format(
+            "phase", "calls", "secs", "secs/call", "peak KB", "retained KB"))
+        for phase in self.phases:
+            if phase not in self.totals:
+                continue
+            (calls, secs, peak, retained) = self.totals[phase]
+            report.write(
+                "{:<12}{:>8}{:>12.3f}{:>12.4f}{:>14.1f}{:>14.1f}\n".format(
+                    phase, calls, secs, secs / calls,
+                    peak / 1024, retained / 1024))
+
+        for phase in self.phases:
+            if phase not in self.profiles:
+                continue
+            profile = self.profiles[phase]
+            profile.dump_stats("{}-{}.prof".format(prefix, phase))
+            profile.stream = report
+            for (order, title) in (('cumulative', 'cumulative time'),
+                                   ('tottime', 'own time')):
+                report.write("\n=== {}: functions by {}\n".format(
+                    phase, title))
+                profile.sort_stats(order).print_stats(self.lines)
+
+        filters = [tracemalloc.Filter(False, module.__file__)
+                   for module in (tracemalloc, cProfile, pstats)]
+        snapshot = snapshot.filter_traces(filters)
+        report.write("\n=== Memory in use at the end, by allocation site\n")
+        for stat in snapshot.statistics('lineno')[:self.lines]:
+            report.write("{}\n".format(stat))
+        report.write("\n=== Memory growth since the first cycle\n")
+        for stat in snapshot.compare_to(
+                self.first_snapshot.filter_traces(filters),
+                'lineno')[:self.lines]:
+            report.write("{}\n".format(stat))
+
+
+class Fleet:
+
+    """Poll many BIND9 servers concurrently with a bounded pool of worker
+    threads, and send their metrics over one shared Graphite connection.
+    Each target is polled at its own phase into the interval (see
+    poll_phase()), so that with the jitter option the polls of the
+    fleet are spread over the interval. Each target's data is sent as
+    soon as it has been collected, also if that is after the end of its
+    run, and a target whose previous poll is still running is skipped,
+    so a slow or dead server does not hold up the others."""
+
+    def __init__(self, targets, sender, poll_interval, workers=16,
+                 debug=False):
+        self.targets = sorted(targets, key=lambda x: x.phase)
+        self.sender = sender
+        self.poll_interval = poll_interval
+        self.debug = debug
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.running = {}              # target name -> Future
+        self.pending = {}              # Future not sent -> (target, due)
+
+    def timed_collect(self, target, slot):
+        """Collect target's data, returning (collected, elapsed)"""
+        time_start = time.time()
+        try:
+            collected = target.collect(slot)
+        except Exception as einfo:
+            log_message("ERROR: {}: poll failed: {}".format(target.name, einfo))
+            collected = False
+        return collected, time.time() - time_start
+
+    def output_result(self, future, target, due):
+        """Send the data collected by a finished poll of target, which
+        was due to finish by time due (in time.monotonic() time)"""
+        collected, elapsed = future.result()
+        if collected:
+            if time.monotonic() > due:
+                log_message("WARN: {}: sending data of poll that finished "
+                            "late".format(target.name))
+            target.output()
+        if self.debug:
+            log_message("{} {}".format(target.name, target.timing_info(elapsed)))
+
+    def output_until(self, until):
+        """Send the data of pending polls as they finish, until time
+        until (in time.monotonic() time)"""
+        while True:
+            timeout = until - time.monotonic()
+            if timeout <= 0:
+                return
+            if not self.pending:
+                time.sleep(timeout)
+                return
+            done, _ = wait(self.pending, timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                self.output_result(future, *self.pending.pop(future))
+
+    def single_run(self, slot, start):
+        """A single run of polling all targets for the given scheduler
+        slot, which started at time start (in time.monotonic() time):
+        each target's poll is started at its phase after start, and the
+        data of the polls is sent as they finish, until the end of the
+        run"""
+
+        for target in self.targets:
+            self.output_until(start + target.phase)
+            future = self.running.get(target.name)
+            if future is not None and not future.done():
+                log_message("WARN: {}: previous poll still running. "
+                            "Skipping.".format(target.name))
+                continue
+            future = self.executor.submit(self.timed_collect, target, slot)
+            self.running[target.name] = future
+            self.pending[future] = (target, start + target.phase +
+                                    self.poll_interval)
+        self.output_until(start + self.poll_interval)
+
+    def run(self):
+        """Run loop: start a run every poll_interval seconds, on
+        multiples of it"""
+        scheduler = Scheduler(self.poll_interval)
+        for target in self.targets:
+            target.scheduler = scheduler
+        while True:
+            slot = scheduler.wait()
+            self.single_run(slot, scheduler.deadline)
 
 
 if __name__ == '__main__':
 
     process_args(sys.argv[1:])
 
+    if Prefs.TARGETS is None:
+        targets = [(Prefs.HOSTNAME, Prefs.BIND9_HOST, Prefs.BIND9_PORT)]
+    else:
+        try:
+            targets = read_targets(Prefs.TARGETS)
+        except (OSError, ValueError) as einfo:
+            usage("Error reading targets: {}".format(einfo))
+
     if Prefs.DAEMON:
         daemon(dirname=Prefs.WORKDIR)
     log_message("starting with host {}, graphite server: {},{}".format(
-        Prefs.HOSTNAME, Prefs.GRAPHITE_HOST, Prefs.GRAPHITE_PORT))
+        ",".join(x[0] for x in targets),
+        Prefs.GRAPHITE_HOST, Prefs.GRAPHITE_PORT))
 
     graphs = Graphs(METRICS)
 
-    b9_stats = Bind9Stats(Prefs.BIND9_HOST, Prefs.BIND9_PORT, Prefs.TIMEOUT,
-                          poll_interval=Prefs.POLL_INTERVAL)
-
-    Bind2Graphite(b9_stats,
-                  Prefs.GRAPHITE_HOST, Prefs.GRAPHITE_PORT,
-                  name=Prefs.HOSTNAME,
-                  timeout=Prefs.TIMEOUT,
-                  poll_interval=Prefs.POLL_INTERVAL,
-                  debug=Prefs.DEBUG).run()
+    sender_class = PickleSender if Prefs.PICKLE else GraphiteSender
+    sender_options = dict(replay_budget=Prefs.SPOOL_REPLAY * 1024)
+    if Prefs.SPOOL_DIR is not None:
+        sender_options['spool'] = Spool(Prefs.SPOOL_DIR, sender_class.protocol,
+                                        Prefs.SPOOL_SIZE * 1024 * 1024,
+                                        Prefs.SPOOL_AGE)
+    if Prefs.PICKLE:
+        sender_options['batch_size'] = Prefs.BATCH_SIZE
+    graphite_sender = sender_class(Prefs.GRAPHITE_HOST, Prefs.GRAPHITE_PORT,
+                                   Prefs.TIMEOUT, **sender_options)
+    if Prefs.SEND and Prefs.QUEUE_SIZE > 0:
+        graphite_sender = SenderQueue(graphite_sender, Prefs.QUEUE_SIZE)
+
+    phases = [0] * len(targets)
+    if Prefs.JITTER is not None:
+        phases = [poll_phase(x[0], Prefs.JITTER) for x in targets]
+        if len(targets) == 1:
+            log_message("polling {:.3f}s into each interval".format(
+                phases[0]))
+        else:
+            log_message("polling {} targets {:.3f}s to {:.3f}s into each "
+                        "interval".format(len(targets), min(phases),
+                                          max(phases)))
+
+    exporter = None
+    if Prefs.PROMETHEUS is not None:
+        exporter = PrometheusExporter(*Prefs.PROMETHEUS)
+
+    b2g_list = []
+    for ((target_name, bind9_host, bind9_port), phase) in zip(targets,
+                                                              phases):
+        b9_stats = Bind9Stats(bind9_host, bind9_port, Prefs.TIMEOUT,
+                              poll_interval=Prefs.POLL_INTERVAL,
+                              paths=graphs.stream_paths() if Prefs.STREAM else None,
+                              resources=graphs.resources() if Prefs.SPLIT else None,
+                              stats_type=Prefs.STATS_TYPE,
+                              zone_counters=graphs.zonestats_location
+                              if graphs.metrics['zonestats'] else None,
+                              compress=Prefs.COMPRESS,
+                              memory_contexts=graphs.memcontexts_location
+                              if graphs.metrics['memcontexts'] else None,
+                              top_contexts=Prefs.MEMTOP,
+                              context_growth=Prefs.MEMGROWTH)
+        b2g_list.append(Bind2Graphite(b9_stats,
+                                      Prefs.GRAPHITE_HOST, Prefs.GRAPHITE_PORT,
+                                      name=target_name,
+                                      timeout=Prefs.TIMEOUT,
+                                      poll_interval=Prefs.POLL_INTERVAL,
+                                      debug=Prefs.DEBUG,
+                                      sender=graphite_sender,
+                                      exporter=exporter,
+                                      sample_interval=Prefs.SAMPLE,
+                                      phase=phase))
+
+    if Prefs.TARGETS is None:
+        runner = b2g_list[0]
+    else:
+        runner = Fleet(b2g_list, graphite_sender, Prefs.POLL_INTERVAL,
+                       workers=Prefs.WORKERS, debug=Prefs.DEBUG)
+    if Prefs.PROFILE_DIR is not None:
+        Profiler(Prefs.PROFILE_DIR, Prefs.PROFILE_CYCLES).attach(runner)
+    runner.run()
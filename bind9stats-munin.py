@@ -3,19 +3,25 @@
 """
 Munin monitoring plug-in for BIND9 DNS statistics server. Tested
 with BIND 9.10, 9.11, and 9.12, exporting version 3.x of the XML
-statistics.
+statistics. Version 1.x of the JSON statistics can be used instead
+by setting STATS_TYPE=json.
 
 Copyright (c) 2013-2015, Shumon Huque. All rights reserved.
 This program is free software; you can redistribute it and/or modify
 it under the same terms as Python itself.
 """
 
-import os, sys
+import os, sys, re, time
+import json
+import zlib
+import fcntl
+import hashlib
+import tempfile
 import xml.etree.ElementTree as et
 try:
-    from urllib2 import urlopen                  # for Python 2
+    from urllib2 import urlopen, Request         # for Python 2
 except ImportError:
-    from urllib.request import urlopen           # for Python 3
+    from urllib.request import urlopen, Request  # for Python 3
 
 VERSION = "0.31"
 
@@ -24,15 +30,50 @@ PORT = os.environ.get('PORT', "8053")
 INSTANCE = os.environ.get('INSTANCE', "")
 SUBTITLE = os.environ.get('SUBTITLE', "")
 
-STATS_TYPE = "xml"                           # will support json later
+STATS_TYPE = os.environ.get('STATS_TYPE', "xml")     # xml or json
+VIEWS = os.environ.get('VIEWS', "")                  # default: all views
+SKIPVIEWS = os.environ.get('SKIPVIEWS', "_bind")
 BINDSTATS_URL = "http://%s:%s/%s" % (HOST, PORT, STATS_TYPE)
 
+# Snapshot cache shared by the plugin runs of a munin cycle (seconds, 0: off).
+# It is kept in munin-node's plugin state directory, and is off without
+# one, rather than in a world-writable directory like /tmp, where other
+# users could plant the cache or lock file.
+CACHE_TTL = int(os.environ.get('CACHE_TTL', "60"))
+CACHE_DIR = os.environ.get('MUNIN_PLUGSTATE')
+
+# Ask for compressed (deflate or gzip) responses, e.g. over slow links
+COMPRESS = os.environ.get('COMPRESS', "no") == "yes"
+
+# munin-node sets this if the master accepts values in the config run
+DIRTYCONFIG = os.environ.get('MUNIN_CAP_DIRTYCONFIG', "") == "1"
+
 if SUBTITLE != '':
     SUBTITLE = ' ' + SUBTITLE
 
 GraphCategoryName = "dns_bind"
 
-# Note: munin displays these graphs ordered alphabetically by graph title
+# JSON statistics members and the XML counters types they correspond to
+JSON_SERVER_COUNTERS = (
+    ('opcodes', 'opcode'),
+    ('rcodes', 'rcode'),
+    ('qtypes', 'qtype'),
+    ('nsstats', 'nsstat'),
+    ('zonestats', 'zonestat'),
+    ('resstats', 'resstat'),
+    ('sockstats', 'sockstat'),
+)
+JSON_RESOLVER_COUNTERS = (
+    ('qtypes', 'resqtype'),
+    ('stats', 'resstats'),
+    ('adb', 'adbstat'),
+    ('cachestats', 'cachestats'),
+)
+
+# Note: munin displays these graphs ordered alphabetically by graph title.
+# Graphs with scope='view' have locations relative to a view, and are
+# drawn for each view selected by VIEWS and SKIPVIEWS (comma separated).
+# Graphs of views other than _default get the view name appended.
 
 GraphConfig = (
 
@@ -75,7 +116,8 @@ GraphConfig = (
           stattype='cachedb',
           args='-l 0',
           vlabel='Count',
-          location="views/view[@name='_default']/cache[@name='_default']/rrset",
+          scope='view',
+          location="cache/rrset",
           config=dict(type='GAUGE', min=0))),
 
     ('dns_resolver_stats' + INSTANCE,
@@ -93,7 +135,8 @@ GraphConfig = (
           stattype='counter',
           args='-l 0',
           vlabel='Count/sec',
-          location="views/view[@name='_default']/counters[@type='resqtype']/counter",
+          scope='view',
+          location="counters[@type='resqtype']/counter",
           config=dict(type='DERIVE', min=0))),
 
     ('dns_resolver_stats_view' + INSTANCE,
@@ -102,7 +145,8 @@ GraphConfig = (
           stattype='counter',
           args='-l 0',
           vlabel='Count/sec',
-          location="views/view[@name='_default']/counters[@type='resstats']/counter",
+          scope='view',
+          location="counters[@type='resstats']/counter",
           config=dict(type='DERIVE', min=0))),
 
     ('dns_cachestats' + INSTANCE,
@@ -111,7 +155,8 @@ GraphConfig = (
           stattype='counter',
           args='-l 0',
           vlabel='Count/sec',
-          location="views/view[@name='_default']/counters[@type='cachestats']/counter",
+          scope='view',
+          location="counters[@type='cachestats']/counter",
           fields=("CacheHits", "CacheMisses", "QueryHits", "QueryMisses",
                   "DeleteLRU", "DeleteTTL"),
           config=dict(type='DERIVE', min=0))),
@@ -122,7 +167,8 @@ GraphConfig = (
           stattype='counter',
           args='-l 0 --base 1024',
           vlabel='Memory In-Use',
-          location="views/view[@name='_default']/counters[@type='cachestats']/counter",
+          scope='view',
+          location="counters[@type='cachestats']/counter",
           fields=("TreeMemInUse", "HeapMemInUse"),
           config=dict(type='GAUGE', min=0))),
 
@@ -190,12 +236,48 @@ GraphConfig = (
           stattype='counter',
           args='-l 0',
           vlabel='Count',
-          location="views/view[@name='_default']/counters[@type='adbstat']/counter",
+          scope='view',
+          location="counters[@type='adbstat']/counter",
           config=dict(type='GAUGE', min=0))),
 
 )
 
 
+def view_selected(viewname):
+    """Is the view selected by the VIEWS and SKIPVIEWS settings?"""
+    if VIEWS and viewname not in VIEWS.split(','):
+        return False
+    return viewname not in SKIPVIEWS.split(',')
+
+
+def graphinstances(etree):
+    """Return (name, title, graph, element) for each enabled graph, where
+    element is what the graph location is relative to: the statistics
+    root, or for view scoped graphs each selected view in turn"""
+
+    views = []
+    for view in etree.findall('views/view'):
+        viewname = view.attrib['name']
+        if view_selected(viewname):
+            views.append((viewname, view))
+
+    results = []
+    for g in GraphConfig:
+        if not g[1]['enable']:
+            continue
+        if g[1].get('scope') != 'view':
+            results.append((g[0], g[1]['title'], g, etree))
+            continue
+        for (viewname, view) in views:
+            if viewname == '_default':
+                results.append((g[0], g[1]['title'], g, view))
+            else:
+                results.append((g[0] + '_' + re.sub(r'\W', '_', viewname),
+                                "%s (view %s)" % (g[1]['title'], viewname),
+                                g, view))
+    return results
+
+
 def unsetenvproxy():
     """Unset HTTP Proxy environment variables that might interfere"""
     for proxyvar in [ 'http_proxy', 'HTTP_PROXY' ]:
@@ -282,46 +364,160 @@ def validkey(graph, key):
         return True
 
 
+def add_counters(parent, ctype, counters):
+    """Add counters element of given type for a JSON counter object"""
+    if not counters:
+        return
+    element = et.SubElement(parent, 'counters', type=ctype)
+    for (name, value) in counters.items():
+        et.SubElement(element, 'counter', name=name).text = str(value)
+
+
+def json_to_etree(stats):
+    """Convert JSON statistics into an ElementTree with the same layout
+    as the XML statistics, so GraphConfig locations work for both"""
+
+    root = et.Element('statistics',
+                      version=str(stats.get('json-stats-version', '')))
+
+    server = et.SubElement(root, 'server')
+    for (member, ctype) in JSON_SERVER_COUNTERS:
+        add_counters(server, ctype, stats.get(member))
+
+    views = et.SubElement(root, 'views')
+    for (viewname, viewdata) in stats.get('views', {}).items():
+        view = et.SubElement(views, 'view', name=viewname)
+        resolver = viewdata.get('resolver', {})
+        for (member, ctype) in JSON_RESOLVER_COUNTERS:
+            add_counters(view, ctype, resolver.get(member))
+        if 'cache' in resolver:
+            cache = et.SubElement(view, 'cache', name=viewname)
+            for (rrtype, count) in resolver['cache'].items():
+                rrset = et.SubElement(cache, 'rrset')
+                et.SubElement(rrset, 'name').text = rrtype
+                et.SubElement(rrset, 'counter').text = str(count)
+
+    if 'memory' in stats:
+        memory = et.SubElement(root, 'memory')
+        summary = et.SubElement(memory, 'summary')
+        for (field, value) in stats['memory'].items():
+            if field != 'contexts':
+                et.SubElement(summary, field).text = str(value)
+
+    return root
+
+
+def cache_path(url):
+    """Return the name of the snapshot cache file for a statistics URL"""
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "bind9stats-%s.cache" % key)
+
+
+def write_cache(path, data):
+    """Atomically replace the snapshot cache file with data"""
+    (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmpname, path)
+    except (IOError, OSError):
+        os.unlink(tmpname)
+        raise
+
+
+def fetch_url(url):
+    """Fetch the statistics at the given URL, with COMPRESS asking
+    for a compressed response, and return them uncompressed"""
+
+    if not COMPRESS:
+        return urlopen(url).read()
+    response = urlopen(Request(url,
+                               headers={'Accept-Encoding': 'deflate, gzip'}))
+    data = response.read()
+    encoding = (response.info().get('Content-Encoding') or '').lower()
+    if encoding in ('deflate', 'gzip', 'x-gzip'):
+        # zlib or gzip header, detected automatically
+        data = zlib.decompress(data, 32 + zlib.MAX_WBITS)
+    return data
+
+
+def get_stats(url):
+    """Return the BIND9 statistics obtained at the given URL. munin-node
+    runs the plugin separately for config and fetch, so a snapshot of
+    the statistics is cached for CACHE_TTL seconds, and the runs of a
+    munin cycle (and other plugin instances using the same URL) share
+    one fetch. The cache is locked while it is checked and refreshed.
+    If it can't be used, or there is no CACHE_DIR, the statistics are
+    fetched directly."""
+
+    if CACHE_TTL <= 0 or not CACHE_DIR:
+        return fetch_url(url)
+
+    path = cache_path(url)
+    try:
+        lockfile = open(path + ".lock", "a")
+    except (IOError, OSError):
+        return fetch_url(url)
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            if time.time() - os.path.getmtime(path) < CACHE_TTL:
+                with open(path, 'rb') as f:
+                    return f.read()
+        except (IOError, OSError):
+            pass
+        data = fetch_url(url)
+        try:
+            write_cache(path, data)
+        except (IOError, OSError):
+            pass
+        return data
+    finally:
+        lockfile.close()
+
+
 def get_etree_root(url):
     """Return the root of an ElementTree structure populated by
     parsing BIND9 statistics obtained at the given URL"""
 
-    data = urlopen(url)
-    return et.parse(data).getroot()
+    data = get_stats(url)
+    if STATS_TYPE == "json":
+        return json_to_etree(json.loads(data.decode('utf-8')))
+    return et.fromstring(data)
 
 
 def muninconfig(etree):
-    """Generate munin config for the BIND stats plugin"""
+    """Generate munin config for the BIND stats plugin, and with
+    dirtyconfig the values too, saving munin-node a fetch run"""
 
-    for g in GraphConfig:
-        if not g[1]['enable']:
-            continue
-        print("multigraph %s" % g[0])
-        print("graph_title %s" % g[1]['title'] + SUBTITLE)
+    for (name, title, g, element) in graphinstances(etree):
+        print("multigraph %s" % name)
+        print("graph_title %s" % title + SUBTITLE)
         print("graph_args %s" % g[1]['args'])
         print("graph_vlabel %s" % g[1]['vlabel'])
         print("graph_category %s" % GraphCategoryName)
 
-        data = getdata(g, etree, getvals=False)
+        data = getdata(g, element, getvals=True)
         if data != None:
-            for key in data:
+            for (key, value) in data:
                 if validkey(g, key):
                     print("%s.label %s" % (key, key))
                     if 'draw' in g[1]['config']:
                         print("%s.draw %s" % (key, g[1]['config']['draw']))
                     print("%s.min %s" % (key, g[1]['config']['min']))
                     print("%s.type %s" % (key, g[1]['config']['type']))
+                    if DIRTYCONFIG:
+                        print("%s.value %s" % (key, value))
         print('')
 
 
 def munindata(etree):
     """Generate munin data for the BIND stats plugin"""
 
-    for g in GraphConfig:
-        if not g[1]['enable']:
-            continue
-        print("multigraph %s" % g[0])
-        data = getdata(g, etree, getvals=True)
+    for (name, title, g, element) in graphinstances(etree):
+        print("multigraph %s" % name)
+        data = getdata(g, element, getvals=True)
         if data != None:
             for (key, value) in data:
                 if validkey(g, key):
@@ -338,20 +534,17 @@ def usage():
 
 if __name__ == '__main__':
 
-    tree = get_etree_root(BINDSTATS_URL)
-
     args = sys.argv[1:]
     argslen = len(args)
+    if argslen > 1 or (argslen == 1 and args[0] not in ("config", "statsversion")):
+        usage()
+
     unsetenvproxy()
+    tree = get_etree_root(BINDSTATS_URL)
 
     if argslen == 0:
         munindata(tree)
-    elif argslen == 1:
-        if args[0] == "config":
-            muninconfig(tree)
-        elif args[0] == "statsversion":
-            print("bind9stats %s version %s" % (STATS_TYPE, getstatsversion(tree)))
-        else:
-            usage()
-    else:
-        usage()
+    elif args[0] == "config":
+        muninconfig(tree)
+    elif args[0] == "statsversion":
+        print("bind9stats %s version %s" % (STATS_TYPE, getstatsversion(tree)))
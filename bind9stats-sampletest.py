@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+bind9stats-sampletest.py
+
+Checks of the sampling mode (-o sample) of bind9stats-graphite.py: a
+Bind2Graphite is fed a sequence of statistics documents, served from
+memory, through full runs and intermediate samples, and the metrics it
+generates are compared with those expected. No BIND or Graphite server
+is needed. Exits with status 1 if any check fails.
+
+"""
+
+import os
+import io
+import sys
+import time
+import importlib.util
+
+
+PROGNAME = os.path.basename(sys.argv[0])
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+
+POLL_INTERVAL = 60
+SAMPLE_INTERVAL = 10
+
+
+class FakeTime:
+
+    """The time module, but with time() set by the test, so that the
+    rates computed from the polls are exact"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        """Wall-clock time"""
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class FakeResponse(io.BytesIO):
+    """An in-memory HTTP response"""
+
+    def __init__(self, data):
+        super().__init__(data or b'')
+        self.status = 200 if data is not None else 503
+        self.reason = 'OK' if data is not None else 'Service Unavailable'
+
+    def getheader(self, name, default=None):
+        """No headers"""
+        return default
+
+
+class FakeConnection:
+
+    """Stand-in for bind9stats-graphite's StatsConnection, serving the
+    statistics document set by the test; None gives an HTTP error"""
+
+    def __init__(self):
+        self.document = None
+        self.requests = 0
+        self.reused = 0
+        self.connects = 0
+        self.wait_time = 0.0
+        self.wire_bytes = 0
+        self.document_bytes = 0
+
+    def url(self, path):
+        """Return URL for the given path, for messages"""
+        return "fake:{}".format(path)
+
+    def get(self, path):
+        """Return the current document"""
+        self.requests += 1
+        return FakeResponse(self.document)
+
+
+def statistics(contexts=None, counters=None):
+    """Return an XML v3 statistics document with the given memory
+    contexts ({id: inuse}) and nsstat counters ({name: value})"""
+    out = ['<statistics version="3.11"><server>'
+           '<counters type="nsstat">']
+    for (name, value) in sorted((counters or {}).items()):
+        out.append('<counter name="{}">{}</counter>'.format(name, value))
+    out.append('</counters></server><views/><memory><contexts>')
+    for (ctxid, inuse) in sorted((contexts or {}).items()):
+        out.append('<context><id>{}</id><name>ctx</name><inuse>{}</inuse>'
+                   '</context>'.format(ctxid, inuse))
+    out.append('</contexts><summary><InUse>0</InUse></summary>'
+               '</memory></statistics>')
+    return ''.join(out).encode()
+
+
+def make_target(metrics, memgrowth=False):
+    """Return a Bind2Graphite in sampling mode, for the given metric
+    types, polling a FakeConnection"""
+    for metric in b9g.METRICS:
+        b9g.METRICS[metric] = metric in metrics
+    b9g.Prefs.DERIVE = True
+    b9g.graphs = b9g.Graphs(b9g.METRICS)
+    stats = b9g.Bind9Stats('fake', 0, 5, poll_interval=POLL_INTERVAL,
+                           memory_contexts=b9g.graphs.memcontexts_location,
+                           top_contexts=10, context_growth=memgrowth)
+    stats.conn = FakeConnection()
+    return b9g.Bind2Graphite(stats, 'graphite', 0, name='ns1',
+                             poll_interval=POLL_INTERVAL,
+                             sample_interval=SAMPLE_INTERVAL)
+
+
+def check_memgrowth():
+    """Memory context growth sent with a full run is the growth since
+    the previous full run, not since the last intermediate sample"""
+    failures = []
+    target = make_target(('memcontexts',), memgrowth=True)
+    conn = target.stats.conn
+    steps = [
+        ('run', {'0x1': 100, '0x2': 1000}),
+        ('sample', {'0x1': 150, '0x2': 1000}),
+        ('sample', {'0x1': 500, '0x2': 1100}),
+        ('run', {'0x1': 600, '0x2': 1200}),
+        ('sample', {'0x1': 700, '0x2': 1200}),
+        ('run', {'0x1': 650, '0x2': 1300}),
+    ]
+    expected = [
+        {},                            # no growth known yet
+        {'0x1': 500, '0x2': 200},
+        {'0x1': 50, '0x2': 100},
+    ]
+    results = []
+    for (slot, (kind, contexts)) in enumerate(steps):
+        conn.document = statistics(contexts)
+        if kind == 'sample':
+            target.sample()
+            continue
+        target.collect(slot * POLL_INTERVAL)
+        results.append({path.split('.')[-2]: value
+                        for (path, value) in target.uncached
+                        if path.endswith('.growth')})
+    for (i, (result, wanted)) in enumerate(zip(results, expected)):
+        if result != wanted:
+            failures.append("memgrowth: run {}: growth {}, expected {}"
+                            .format(i, result, wanted))
+    return failures
+
+
+def check_failed_run():
+    """A polling interval whose full run failed does not carry its
+    samples over into the aggregates of the next interval"""
+    failures = []
+    target = make_target(('auth',))
+    conn = target.stats.conn
+    sent = []
+    target.output = lambda: sent.append(dict(target.datapoints))
+    b9g.time = clock = FakeTime()
+    counter = 0
+    for slot in range(0, 3 * POLL_INTERVAL + 1, SAMPLE_INTERVAL):
+        period = slot // POLL_INTERVAL
+        if slot == POLL_INTERVAL:
+            conn.document = None       # the full run of period 1 fails
+        else:
+            counter += 1000 if period == 0 else 10
+            conn.document = statistics(counters={'QryUDP': counter})
+        clock.now = 1000000.0 + slot
+        target.sampled_run(slot)
+    b9g.time = time
+    if len(sent) != 2:
+        return ["failed run: {} runs sent, expected 2".format(len(sent))]
+    for (run, datapoints) in enumerate(sent):
+        rates = {path.split('.')[-2]: value
+                 for (path, value) in datapoints.items()
+                 if path.endswith('.QryUDP')}
+        if rates.get('dns_server_stats_max') != 1.0 or \
+           rates.get('dns_server_stats_last') != 1.0:
+            failures.append("failed run: run {} rates {}".format(
+                run, rates))
+    return failures
+
+
+def main():
+    """Run the checks and report"""
+    failures = []
+    for check in (check_memgrowth, check_failed_run):
+        result = check()
+        print("{:20s} {}".format(check.__name__,
+                                 "FAIL" if result else "ok"))
+        failures += result
+    for failure in failures:
+        print("  " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        print("Usage: {}".format(PROGNAME))
+        sys.exit(1)
+
+    spec = importlib.util.spec_from_file_location(
+        'bind9stats_graphite', os.path.join(SRCDIR, 'bind9stats-graphite.py'))
+    b9g = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(b9g)
+    b9g.log_message = lambda msg: None
+
+    sys.exit(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+bind9stats-schedtest.py
+
+Checks of the poll scheduler of bind9stats-graphite.py (Scheduler),
+run against a fake monotonic and wall clock, so that days of polling,
+overrunning polls and wall clock steps take a fraction of a second.
+For every scenario, the slots (graphite timestamps) returned must be
+multiples of the interval, go up by whole intervals, never repeat, and
+account for every slot not run as skipped. No BIND or Graphite server
+is needed. Exits with status 1 if any check fails.
+
+"""
+
+import os
+import sys
+import random
+import importlib.util
+
+
+PROGNAME = os.path.basename(sys.argv[0])
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+
+START_WALL = 1792170013.37                 # an arbitrary unaligned time
+START_MONOTONIC = 1000.0
+
+
+class FakeClock:
+
+    """Monotonic and wall clocks that only move when told to. The wall
+    clock is the monotonic clock plus a step, which can be changed to
+    simulate the wall clock being set"""
+
+    def __init__(self):
+        self.now = START_MONOTONIC
+        self.step = START_WALL - START_MONOTONIC
+
+    def monotonic(self):
+        """Monotonic time"""
+        return self.now
+
+    def wall(self):
+        """Wall-clock time"""
+        return self.now + self.step
+
+    def sleep(self, secs):
+        """Sleep, i.e. move both clocks forward"""
+        if secs < 0:
+            raise ValueError("negative sleep: {}".format(secs))
+        self.now += secs
+
+
+def run_schedule(interval, durations, phase=0, steps=None):
+
+    """Run a Scheduler with runs taking the given durations, stepping
+    the wall clock by steps[i] seconds during run i. Returns the slots,
+    the wall-clock times the runs started, the scheduler and the log
+    messages"""
+
+    clock = FakeClock()
+    messages = []
+    b9g.log_message = messages.append
+    scheduler = b9g.Scheduler(interval, phase, clock=clock.monotonic,
+                              wallclock=clock.wall, sleep=clock.sleep)
+    slots = []
+    starts = []
+    for (i, duration) in enumerate(durations):
+        slot = scheduler.wait()
+        slots.append(slot)
+        starts.append(clock.wall())
+        if steps and i in steps:
+            clock.step += steps[i]
+        clock.now += duration
+    return slots, starts, scheduler, messages
+
+
+def check_slots(name, interval, slots, scheduler):
+    """Check slot invariants common to all scenarios; return a list of
+    failures"""
+    failures = []
+    if any(not isinstance(x, int) for x in slots):
+        failures.append("non-integer slots")
+    if any(x % interval for x in slots):
+        failures.append("slots not aligned to the interval")
+    if len(set(slots)) != len(slots):
+        failures.append("duplicate slots")
+    diffs = [y - x for (x, y) in zip(slots, slots[1:])]
+    if any(x <= 0 or x % interval for x in diffs):
+        failures.append("slots not increasing by whole intervals")
+    return ["{}: {}".format(name, x) for x in failures]
+
+
+def check_aligned():
+    """Runs shorter than the interval: every slot is run, on time"""
+    failures = []
+    rnd = random.Random(1)
+    for (name, interval, durations) in [
+            ("fast runs", 60, [0.5] * 1000),
+            ("slow runs", 60, [rnd.uniform(0, 59.9) for _ in range(1000)]),
+            ("sample interval", 5, [rnd.uniform(0, 4.9) for _ in range(1000)])]:
+        slots, starts, scheduler, _ = run_schedule(interval, durations)
+        failures += check_slots(name, interval, slots, scheduler)
+        if any(y - x != interval for (x, y) in zip(slots, slots[1:])):
+            failures.append("{}: slots missed".format(name))
+        if scheduler.skipped:
+            failures.append("{}: {} skipped".format(name, scheduler.skipped))
+        lateness = max(start - slot for (slot, start) in zip(slots, starts))
+        if lateness > 1e-6:
+            failures.append("{}: runs started {:.3f}s late".format(
+                name, lateness))
+    return failures
+
+
+def check_phase():
+    """With a phase, runs start phase seconds after their slot"""
+    failures = []
+    slots, starts, scheduler, _ = run_schedule(60, [1] * 100, phase=17.25)
+    failures += check_slots("phase", 60, slots, scheduler)
+    if any(abs(start - slot - 17.25) > 1e-6
+           for (slot, start) in zip(slots, starts)):
+        failures.append("phase: runs not started at slot + phase")
+    return failures
+
+
+def check_skips():
+    """Runs overrunning by whole intervals: missed slots are skipped,
+    counted and logged, never run late back to back"""
+    failures = []
+    rnd = random.Random(2)
+    durations = [rnd.choice([1, 10, 60, 65, 130, 200]) for _ in range(1000)]
+    slots, _, scheduler, messages = run_schedule(60, durations)
+    failures += check_slots("overruns", 60, slots, scheduler)
+    missed = sum((y - x) // 60 - 1 for (x, y) in zip(slots, slots[1:]))
+    if missed != scheduler.skipped:
+        failures.append("overruns: {} slots missed, {} counted as skipped"
+                        .format(missed, scheduler.skipped))
+    logged = sum(int(x.split()[4]) for x in messages if "skipping" in x)
+    if logged != missed:
+        failures.append("overruns: {} skips logged, {} missed".format(
+            logged, missed))
+    if not missed:
+        failures.append("overruns: nothing skipped")
+    slots, _, scheduler, _ = run_schedule(60, [60.0] * 50)
+    failures += check_slots("exactly one interval", 60, slots, scheduler)
+    return failures
+
+
+def check_clock_steps():
+    """Wall clock stepped forward or back: the schedule realigns, and
+    never repeats a slot"""
+    failures = []
+    for step in (3600, 45, -10, -40, -59, -90, -3600):
+        name = "wall clock step {:+d}s".format(step)
+        slots, _, scheduler, messages = run_schedule(60, [1] * 10,
+                                                     steps={4: step})
+        failures += check_slots(name, 60, slots, scheduler)
+        realigned = any("realigning" in x for x in messages)
+        if realigned != (abs(step) >= 30):
+            failures.append("{}: realigned={}".format(name, realigned))
+    return failures
+
+
+def main():
+    """Run the checks and report"""
+    failures = []
+    for check in (check_aligned, check_phase, check_skips, check_clock_steps):
+        result = check()
+        print("{:20s} {}".format(check.__name__,
+                                 "FAIL" if result else "ok"))
+        failures += result
+    for failure in failures:
+        print("  " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        print("Usage: {}".format(PROGNAME))
+        sys.exit(1)
+
+    spec = importlib.util.spec_from_file_location(
+        'bind9stats_graphite', os.path.join(SRCDIR, 'bind9stats-graphite.py'))
+    b9g = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(b9g)
+
+    sys.exit(main())